@@ -26,7 +26,7 @@ async def delay_check_call(sec, cmd):
     check_call(cmd.split(' '))
 
 async def button_poweroff():
-    cozmars_rpc_server.screen.image(util.poweroff_screen())
+    cozmars_rpc_server.display_worker.draw(util.screen_data('poweroff'), 0, 0)
     cozmars_rpc_server._screen_backlight(.02)
     cozmars_rpc_server.speaker_volume(50)
     try:
@@ -37,7 +37,7 @@ async def button_poweroff():
 
 def idle():
     global cozmars_rpc_server, server_loop
-    cozmars_rpc_server.screen.image(util.splash_screen())
+    cozmars_rpc_server.display_worker.draw(util.screen_data('splash'), 0, 0)
     cozmars_rpc_server.button.when_pressed = lambda: lightup_screen(5)
     cozmars_rpc_server.button.hold_time = 5
     cozmars_rpc_server.button.when_held = lambda: asyncio.run_coroutine_threadsafe(button_poweroff(), server_loop)
@@ -50,6 +50,8 @@ async def before_server_start(request, loop):
     server_loop = loop
     dim_screen_task = None
     cozmars_rpc_server = CozmarsServer()
+    for name in ('splash', 'poweroff', 'reboot'):
+        util.screen_data(name)
     idle()
     lightup_screen(5)
     cozmars_rpc_server.speaker_volume(50)
@@ -93,6 +95,32 @@ async def rpc(request, ws):
         finally:
             idle()
 
+@app.route('/camera.mjpg')
+def mjpeg(request):
+    # watch the camera in a browser, e.g. /camera.mjpg?width=320&height=240&fps=10
+    # it shares the camera with the `camera` rpc, every viewer gets the latest frame at its own pace
+    try:
+        width, height = int(request.args.get('width', 320)), int(request.args.get('height', 240))
+        fps = float(request.args.get('fps', 10))
+        if not (0 < width <= 1280 and 0 < height <= 720 and 0 < fps <= 30):
+            raise ValueError
+    except ValueError:
+        return sanic.response.text('width must be 1~1280, height 1~720, fps 0~30', status=400)
+
+    async def streaming_fn(response):
+        sub = await cozmars_rpc_server.camera_manager.subscribe((width, height), fps)
+        try:
+            interval = 1/fps
+            next_t = server_loop.time()
+            while True:
+                frame = await sub.get()
+                await response.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (len(frame), frame))
+                next_t = max(next_t + interval, server_loop.time())
+                await asyncio.sleep(next_t - server_loop.time())
+        finally:
+            cozmars_rpc_server.camera_manager.unsubscribe(sub)
+    return sanic.response.stream(streaming_fn, content_type='multipart/x-mixed-replace; boundary=frame')
+
 def redirect_html(sec, url, txt):
     return f"""<html>
         <head><meta charset='utf-8'/><meta http-equiv='refresh' content='{str(sec)};url={url}' /></head>
@@ -111,14 +139,14 @@ def restart_server(request):
 
 @app.route('/poweroff')
 def poweroff(request):
-    cozmars_rpc_server.screen.image(util.poweroff_screen())
+    cozmars_rpc_server.display_worker.draw(util.screen_data('poweroff'), 0, 0)
     cozmars_rpc_server.screen_backlight.fraction = .1
     asyncio.create_task(delay_check_call(5, 'sudo poweroff'))
     return sanic.response.html("""<p>{}<br> {}</p>""".format(_("Shutting down"), _("Please wait for the power light in the head of the Cozmars robot to go out before pressing the power button on the side.")))
 
 @app.route('/reboot')
 def reboot(request):
-    cozmars_rpc_server.screen.image(util.reboot_screen())
+    cozmars_rpc_server.display_worker.draw(util.screen_data('reboot'), 0, 0)
     cozmars_rpc_server.screen_backlight.fraction = .1
     asyncio.create_task(delay_check_call(5, 'sudo reboot'))
     return sanic.response.html(redirect_html(60, '/', """<p>{}... </p> <p>{}</p>""".format(_("Rebooting"), _("This takes about a minute"))))
@@ -0,0 +1,59 @@
+import asyncio, io
+from PIL import Image, ImageSequence
+from .framebuffer import dirty_rects
+from .image_codec import rgb565, fit, decode
+
+class Animation:
+    '''
+    Frames pre-converted to RGB565 and delta-encoded:
+    the first frame is kept whole, every frame (including the first one, for looping) is kept
+    as the rectangles that changed since the previous frame
+    '''
+    def __init__(self, frames, durations):
+        self.height, self.width = frames[0].shape
+        self.durations = durations
+        self.first = frames[0]
+        self.deltas = []
+        for prev, cur in zip(frames[-1:] + frames[:-1], frames):
+            self.deltas.append([(x, y, cur[y:y1+1, x:x1+1].copy()) for x, y, x1, y1 in dirty_rects(prev != cur)])
+        self.nbytes = self.first.nbytes + sum(b.nbytes for d in self.deltas for _, _, b in d)
+
+    def __len__(self):
+        return len(self.durations)
+
+    @staticmethod
+    def from_image(data, w, h, duration=100):
+        # animated GIF/APNG, or a still image
+        frames, durations = [], []
+        with Image.open(io.BytesIO(data)) as img:
+            for frame in ImageSequence.Iterator(img):
+                frames.append(fit(rgb565(frame), w, h))
+                durations.append(frame.info.get('duration') or duration)
+        return Animation(frames, durations)
+
+    @staticmethod
+    def from_frames(frames, format, w, h, durations=100, palette=None, bits=8):
+        if not isinstance(durations, (list, tuple)):
+            durations = [durations] * len(frames)
+        if len(durations) != len(frames):
+            raise ValueError('durations and frames must be of the same length')
+        return Animation([decode(f, format, w, h, palette, bits) for f in frames], list(durations))
+
+async def play(anim, display_worker, x, y, loop=1):
+    '''play `anim` at (x, y) `loop` times, or forever if `loop` is 0'''
+    display_worker.draw(anim.first, x, y)
+    clock = asyncio.get_running_loop().time
+    next_t = clock() + anim.durations[0] / 1000
+    n = 0
+    while not loop or n < loop:
+        for i in range(1, len(anim) + 1):
+            if i == len(anim):
+                if loop and n + 1 == loop:
+                    break
+                i = 0
+            await asyncio.sleep(next_t - clock())
+            for dx, dy, block in anim.deltas[i]:
+                display_worker.draw(block, x+dx, y+dy)
+            next_t += anim.durations[i] / 1000
+        n += 1
+    await asyncio.sleep(next_t - clock())
@@ -0,0 +1,138 @@
+'''
+Compressed formats for 16-bit mono PCM streamed to the speaker and from the microphone.
+
+* ``'pcm'``: no compression
+* ``'ulaw'``: G.711 μ-law, 8 bits per sample
+* ``'adpcm'``: IMA-ADPCM, 4 bits per sample. Every block starts with the decoder state, a little-endian int16 predicted
+  sample and a uint8 step index and a padding byte, followed by 2 samples per byte, the first one in the high nibble
+  (as Python's `audioop` does), so blocks can be decoded on their own, and a dropped block doesn't garble the following ones
+* ``'opus'``: if `opuslib` is installed, each block must be 2.5, 5, 10, 20, 40 or 60 ms long
+
+The C implementations in `audioop` are used when it's available (it's gone since Python 3.13), otherwise NumPy/pure Python.
+Blocks should be encoded/decoded in an executor, not on the event loop
+'''
+import struct
+import numpy as np
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+FORMATS = ('pcm', 'ulaw', 'adpcm') + (('opus',) if opuslib else ())
+
+ULAW_BIAS = 0x84
+ULAW_SEGMENTS = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]) # segment ends of 14-bit magnitudes
+
+def ulaw_encode(pcm):
+    if audioop:
+        return audioop.lin2ulaw(pcm, 2)
+    # the same 14-bit G.711 encoder as `audioop`
+    x = np.frombuffer(pcm, dtype='<i2').astype(np.int32) >> 2
+    mask = np.where(x < 0, 0x7F, 0xFF)
+    x = np.minimum(np.abs(x), 8159) + (ULAW_BIAS >> 2)
+    seg = np.searchsorted(ULAW_SEGMENTS, x)
+    u = np.where(seg < 8, (seg << 4) | ((x >> (seg + 1)) & 0x0F), 0x7F)
+    return (u ^ mask).astype(np.uint8).tobytes()
+
+def ulaw_decode(data):
+    if audioop:
+        return audioop.ulaw2lin(data, 2)
+    u = ~np.frombuffer(data, dtype=np.uint8).astype(np.int32) & 0xFF
+    exponent, mantissa = (u >> 4) & 0x07, u & 0x0F
+    x = (((mantissa << 3) + ULAW_BIAS) << exponent) - ULAW_BIAS
+    return np.where(u & 0x80, -x, x).astype('<i2').tobytes()
+
+ADPCM_INDEX = (-1, -1, -1, -1, 2, 4, 6, 8) * 2
+ADPCM_STEPS = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97, 107, 118,
+    130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358,
+    5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623,
+    27086, 29794, 32767)
+ADPCM_HEADER = struct.Struct('<hBx')
+
+def _adpcm_step(code, predicted, index):
+    step = ADPCM_STEPS[index]
+    diff = step >> 3
+    if code & 4: diff += step
+    if code & 2: diff += step >> 1
+    if code & 1: diff += step >> 2
+    predicted = max(-32768, min(32767, predicted - diff if code & 8 else predicted + diff))
+    return predicted, max(0, min(88, index + ADPCM_INDEX[code]))
+
+def _adpcm_encode(samples, predicted, index):
+    out = bytearray((len(samples) + 1) // 2)
+    for i, x in enumerate(samples):
+        step = ADPCM_STEPS[index]
+        diff = x - predicted
+        code = 8 if diff < 0 else 0
+        diff = abs(diff)
+        if diff >= step: code |= 4; diff -= step
+        if diff >= step >> 1: code |= 2; diff -= step >> 1
+        if diff >= step >> 2: code |= 1
+        predicted, index = _adpcm_step(code, predicted, index)
+        out[i >> 1] |= code if i & 1 else code << 4
+    return bytes(out), (predicted, index)
+
+def _adpcm_decode(data, predicted, index, n):
+    out = np.empty(n, dtype='<i2')
+    for i in range(n):
+        code = data[i >> 1] & 0x0F if i & 1 else data[i >> 1] >> 4
+        predicted, index = _adpcm_step(code, predicted, index)
+        out[i] = predicted
+    return out.tobytes()
+
+class Codec:
+    '''encodes/decodes blocks of 16-bit mono PCM, one instance per stream since some formats keep state between blocks'''
+    def __init__(self, format, samplerate):
+        if format not in FORMATS:
+            raise ValueError(f'Unknown audio format {format}, must be one of {FORMATS}')
+        self.format = format
+        self.samplerate = samplerate
+        self._state = (0, 0) # ADPCM encoder (predicted sample, step index)
+        if format == 'opus':
+            self._encoder = opuslib.Encoder(samplerate, 1, opuslib.APPLICATION_VOIP)
+            self._decoder = opuslib.Decoder(samplerate, 1)
+
+    def encode(self, pcm):
+        if self.format == 'ulaw':
+            return ulaw_encode(pcm)
+        if self.format == 'adpcm':
+            header = ADPCM_HEADER.pack(*self._state)
+            if audioop:
+                # `audioop` state is (predicted, index) too
+                data, self._state = audioop.lin2adpcm(pcm, 2, self._state)
+            else:
+                data, self._state = _adpcm_encode(np.frombuffer(pcm, dtype='<i2').tolist(), *self._state)
+            return header + data
+        if self.format == 'opus':
+            return self._encoder.encode(pcm, len(pcm) // 2)
+        return pcm
+
+    def decode(self, data):
+        if self.format == 'ulaw':
+            return ulaw_decode(data)
+        if self.format == 'adpcm':
+            state = ADPCM_HEADER.unpack_from(data)
+            data = data[ADPCM_HEADER.size:]
+            if audioop:
+                return audioop.adpcm2lin(data, 2, state)[0]
+            return _adpcm_decode(data, *state, len(data) * 2)
+        if self.format == 'opus':
+            # the longest opus frame is 120 ms
+            return self._decoder.decode(bytes(data), self.samplerate * 120 // 1000)
+        return data
+
+def negotiate(formats):
+    '''the first of `formats` that's available here'''
+    formats = [formats] if isinstance(formats, str) else formats
+    for f in formats:
+        if f in FORMATS:
+            return f
+    raise ValueError(f'None of the audio formats {formats} is available, must be one of {FORMATS}')
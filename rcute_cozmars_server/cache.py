@@ -0,0 +1,50 @@
+import hashlib
+from collections import OrderedDict
+
+class LRUCache:
+    '''
+    Items (animations, sounds, anything with `nbytes`) keyed by the hash of their content,
+    least recently used ones are evicted when `max_bytes` is exceeded. `kind` names the items in error messages
+    '''
+    def __init__(self, max_bytes, kind='Item'):
+        self.max_bytes = max_bytes
+        self.kind = kind
+        self._items = OrderedDict()
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha1()
+        for p in parts:
+            p = p if isinstance(p, (bytes, bytearray)) else repr(p).encode()
+            # length-prefixed, so that frames (b'ab', b'c') and (b'a', b'bc') get different keys
+            h.update(len(p).to_bytes(8, 'little'))
+            h.update(p)
+        return h.hexdigest()
+
+    @property
+    def nbytes(self):
+        return sum(item.nbytes for item in self._items.values())
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        try:
+            self._items.move_to_end(key)
+            return self._items[key]
+        except KeyError:
+            raise KeyError(f'{self.kind} {key} not found, it may have been evicted from cache')
+
+    def __setitem__(self, key, item):
+        if item.nbytes > self.max_bytes:
+            raise ValueError(f'{self.kind} of {item.nbytes} bytes exceeds cache size {self.max_bytes}')
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while self.nbytes > self.max_bytes:
+            self._items.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def keys(self):
+        return list(self._items.keys())
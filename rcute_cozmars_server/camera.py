@@ -0,0 +1,546 @@
+import asyncio, io, functools, time
+from collections import deque
+import numpy as np
+
+class Subscriber:
+    '''
+    Latest-wins slot of a consumer: a new frame replaces the one not taken yet.
+    Frames are immutable bytes shared by all subscribers, nothing is copied per subscriber
+    '''
+    def __init__(self, channel):
+        self.channel = channel
+        self.frame = None
+        self.timestamp = None # time.monotonic() when the frame last returned by `get` was captured, see `capture_time`
+        self.received = self.dropped = 0
+        self.skip = 1 # only take every `skip`th frame
+        self._n = 0
+        self._t = None
+        self._ready = asyncio.Event()
+
+    def put(self, frame, t=None):
+        self._n += 1
+        if self._n % self.skip:
+            return
+        if self.frame is not None:
+            self.dropped += 1
+        self.frame, self._t = frame, t
+        self.received += 1
+        self._ready.set()
+
+    async def get(self):
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self.frame = self.frame, None
+        self.timestamp = self._t
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+class StreamSubscriber(Subscriber):
+    '''
+    For H.264, where every chunk depends on the ones before it, so chunks are queued (up to `maxlen`) instead of replaced.
+    A subscriber starts at a key frame, and if it falls too far behind, the queue is flushed and it waits for the next one,
+    asking the encoder for it with `request_key_frame`
+    '''
+    def __init__(self, channel, request_key_frame, maxlen=30):
+        Subscriber.__init__(self, channel)
+        self.request_key_frame = request_key_frame
+        self.queue = deque()
+        self.maxlen = maxlen
+        self.waiting_key = True
+
+    def put(self, chunk, t=None):
+        data, key = chunk
+        if self.waiting_key:
+            if not key:
+                self.dropped += 1
+                return
+            self.waiting_key = False
+        if len(self.queue) >= self.maxlen:
+            self.dropped += len(self.queue) + 1
+            self.queue.clear()
+            self.waiting_key = True
+            self.request_key_frame()
+            return
+        self.queue.append((data, t))
+        self.received += 1
+        self._ready.set()
+
+    async def get(self):
+        while not self.queue:
+            self._ready.clear()
+            await self._ready.wait()
+        data, self.timestamp = self.queue.popleft()
+        return data
+
+class VideoStream:
+    '''
+    Video for one consumer, with frame counts for reporting.
+
+    If `bitrate` (bytes per second) is given for MJPEG, the stream adapts to it: every `interval` seconds it steps down
+    (lower JPEG quality, then smaller size, then fewer frames) when the consumer goes over budget or
+    falls behind so that frames are dropped from its slot, and steps back up after a few windows with headroom.
+    For H.264 the encoder keeps to its own bitrate, given in `encoder_options` along with the other options for picamera
+    '''
+    QUALITY = (85, 70, 55, 40)
+    SCALE = (1, .75, .5)
+    SKIP = (1, 2, 3)
+
+    def __init__(self, manager, resolution, framerate, bitrate=None, interval=1, format='mjpeg', encoder_options=None):
+        self.manager = manager
+        self.format = format
+        self.resolution = tuple(resolution)
+        self.framerate = framerate
+        self.bitrate = bitrate
+        self.adaptive = bool(bitrate) and format == 'mjpeg'
+        self.interval = interval
+        self.options = encoder_options or {}
+        q, s, k = VideoStream.QUALITY, VideoStream.SCALE, VideoStream.SKIP
+        self.levels = [(a, 1, 1) for a in q] + [(q[-1], a, 1) for a in s[1:]] + [(q[-1], s[-1], a) for a in k[1:]]
+        self.level = 0
+        self.sub = None
+        self.sent = self.dropped = 0
+        self.measured_bitrate = None
+        self._calm = 0
+
+    async def start(self):
+        self.sub = await self._subscribe(self.level)
+        self._new_window()
+        return self
+
+    async def _subscribe(self, level):
+        if not self.adaptive:
+            return await self.manager.subscribe(self.resolution, self.framerate, self.format, **self.options)
+        quality, scale, skip = self.levels[level]
+        # the GPU resizer wants sizes in multiples of 16
+        resize = scale != 1 and tuple(max(16, int(a * scale) // 16 * 16) for a in self.resolution) or None
+        sub = await self.manager.subscribe(self.resolution, self.framerate, self.format, resize=resize, quality=quality, **self.options)
+        sub.skip = skip
+        return sub
+
+    def _new_window(self):
+        self._window_start = self.manager.loop.time()
+        self._window_frames = self._window_bytes = 0
+        self._window_dropped = self.sub.dropped
+
+    async def _switch(self, level):
+        try:
+            sub = await self._subscribe(level)
+        except RuntimeError: # no splitter port free for the new level while the current one is open
+            if self.sub.channel.subscribers != [self.sub]:
+                return # the current channel is shared, stay at this level
+            # free the port first, at the cost of a short gap in the stream
+            self.dropped += self.sub.dropped
+            await self.manager.unsubscribe(self.sub)
+            try:
+                sub = await self._subscribe(level)
+            except RuntimeError: # taken by someone else meanwhile
+                level = self.level
+                sub = await self._subscribe(level)
+            self.sub, self.level = sub, level
+            return
+        self.dropped += self.sub.dropped
+        self.manager.unsubscribe(self.sub)
+        self.sub, self.level = sub, level
+
+    async def _adapt(self):
+        elapsed = self.manager.loop.time() - self._window_start
+        self.measured_bitrate = self._window_bytes / elapsed
+        dropped = self.sub.dropped - self._window_dropped
+        if self.adaptive:
+            behind = dropped > (self._window_frames + dropped) * .25
+            if (behind or self.measured_bitrate > self.bitrate * 1.1) and self.level < len(self.levels) - 1:
+                self._calm = 0
+                await self._switch(self.level + 1)
+            elif not dropped and self.measured_bitrate < self.bitrate * .7 and self.level > 0:
+                self._calm += 1
+                if self._calm >= 3:
+                    self._calm = 0
+                    await self._switch(self.level - 1)
+            else:
+                self._calm = 0
+        self._new_window()
+
+    async def get(self):
+        frame = await self.sub.get()
+        self.sent += 1
+        self._window_frames += 1
+        self._window_bytes += len(frame)
+        if self.manager.loop.time() - self._window_start >= self.interval:
+            await self._adapt()
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def close(self):
+        self.sub and self.manager.unsubscribe(self.sub)
+
+    @property
+    def timestamp(self):
+        return self.sub.timestamp
+
+    def stats(self):
+        quality, scale, skip = self.levels[self.level] if self.adaptive else (None, 1, 1)
+        channel = self.sub.channel
+        # the camera may have been closed since the stream ended
+        cam = self.manager.cam if self.manager.is_open else None
+        return {'format': self.format,
+                'resolution': channel.resize or (tuple(cam.resolution) if cam else self.resolution),
+                'framerate': float(cam.framerate if cam else self.framerate) / skip,
+                'quality': quality,
+                'bitrate': self.measured_bitrate,
+                'target_bitrate': self.bitrate,
+                'sent': self.sent,
+                'dropped': self.dropped + self.sub.dropped}
+
+def capture_time(cam, port):
+    '''
+    time.monotonic() when the frame being recorded on splitter `port` was captured, from its timestamp on the GPU clock,
+    rather than when its encoded data arrives, which is later by the encoding time. Falls back to now if there's no timestamp
+    '''
+    now = time.monotonic()
+    try:
+        # `cam.frame` is only about splitter port 1
+        frame = cam._encoders[port].frame
+        if frame.timestamp is not None:
+            return now - (cam.timestamp - frame.timestamp) / 1e6
+    except Exception:
+        pass
+    return now
+
+class FrameOutput:
+    '''file-like object picamera records MJPEG into, each complete JPEG is handed to `on_frame` on the event loop'''
+    def __init__(self, loop, on_frame, clock=time.monotonic):
+        self.loop = loop
+        self.on_frame = on_frame
+        self.clock = clock # when the frame being written was captured
+        self._buf = io.BytesIO()
+
+    def write(self, b):
+        self._buf.write(b)
+        if bytes(b[-2:]) == b'\xff\xd9': # end of image
+            frame = self._buf.getvalue()
+            self._buf.seek(0)
+            self._buf.truncate()
+            self.loop.call_soon_threadsafe(self.on_frame, frame, self.clock())
+        return len(b)
+
+    def flush(self):
+        pass
+
+def nal_types(data):
+    types = []
+    i = data.find(b'\x00\x00\x01')
+    while 0 <= i < len(data) - 3:
+        types.append(data[i+3] & 0x1F)
+        i = data.find(b'\x00\x00\x01', i+3)
+    return types
+
+class H264Output:
+    '''
+    file-like object picamera records H.264 into, each write (one or a few NAL units) is handed to `on_frame`
+    as (data, key), `key` being True if it starts with a SPS, i.e. a decoder can start from there
+    '''
+    def __init__(self, loop, on_frame, clock=time.monotonic):
+        self.loop = loop
+        self.on_frame = on_frame
+        self.clock = clock
+
+    def write(self, b):
+        b = bytes(b)
+        self.loop.call_soon_threadsafe(self.on_frame, (b, 7 in nal_types(b)), self.clock())
+        return len(b)
+
+    def flush(self):
+        pass
+
+class RawOutput:
+    '''
+    file-like object picamera records unencoded YUV420 into.
+    Frames are written straight into a ring of `ring` preallocated buffers, and consumers get a view of the buffer
+    (the Y plane as a HxW greyscale array for 'gray', the whole padded YUV420 frame for 'yuv'), nothing is copied.
+    A buffer is overwritten `ring` frames later, so consumers must be done with a frame by then or copy it
+    '''
+    def __init__(self, loop, on_frame, size, format='gray', ring=4, clock=time.monotonic):
+        self.loop = loop
+        self.on_frame = on_frame
+        self.clock = clock
+        self.width, self.height = size
+        # the Y plane is padded to multiples of 32x16, U and V planes are a quarter of it each
+        self.pad_width, self.pad_height = -(-self.width // 32) * 32, -(-self.height // 16) * 16
+        self.format = format
+        self.ring = [np.empty(self.pad_width * self.pad_height * 3 // 2, dtype=np.uint8) for _ in range(ring)]
+        self._i = self._pos = 0
+
+    def view(self, buf):
+        if self.format == 'gray':
+            return buf[:self.pad_width * self.pad_height].reshape(self.pad_height, self.pad_width)[:self.height, :self.width]
+        return buf
+
+    def write(self, b):
+        b = np.frombuffer(b, dtype=np.uint8)
+        start = 0
+        while start < b.size:
+            buf = self.ring[self._i]
+            n = min(b.size - start, buf.size - self._pos)
+            buf[self._pos:self._pos+n] = b[start:start+n]
+            self._pos += n
+            start += n
+            if self._pos == buf.size:
+                self.loop.call_soon_threadsafe(self.on_frame, self.view(buf), self.clock())
+                self._i = (self._i + 1) % len(self.ring)
+                self._pos = 0
+        return b.size
+
+    def flush(self):
+        pass
+
+class Channel:
+    '''one recording on a splitter port, shared by all subscribers asking for the same format and size'''
+    RAW_FORMATS = ('gray', 'yuv')
+
+    def __init__(self, loop, port, format, resize, options, size=None, ring=4, clock=time.monotonic):
+        self.port = port
+        self.format = format
+        self.resize = resize
+        self.options = options
+        self.subscribers = []
+        if format in Channel.RAW_FORMATS:
+            self.record_format = 'yuv'
+            self.output = RawOutput(loop, self.dispatch, size, format, ring, clock)
+        elif format == 'h264':
+            self.record_format = format
+            self.output = H264Output(loop, self.dispatch, clock)
+        else:
+            self.record_format = format
+            self.output = FrameOutput(loop, self.dispatch, clock)
+
+    def dispatch(self, frame, t=None):
+        for s in self.subscribers:
+            s.put(frame, t)
+
+    def match(self, format, resize, options):
+        return (self.format, self.resize, self.options) == (format, resize, options)
+
+def fit(size, bound):
+    '''`size` scaled down to fit in `bound` keeping its aspect ratio, even sizes, never scaled up'''
+    k = min(1, bound[0] / size[0], bound[1] / size[1])
+    return tuple(max(2, int(a * k) // 2 * 2) for a in size)
+
+RAW_CHANNELS = {'rgb': 3, 'bgr': 3, 'rgba': 4, 'bgra': 4}
+
+def rotate180(data, format, size, quality=85):
+    '''
+    stills taken from the running video port are not flipped like stills taken alone, turn them around.
+    Unencoded formats are turned in place within their 32x16 padding, encoded ones are encoded again at `quality`, keeping their EXIF
+    '''
+    w, h = size
+    pw, ph = -(-w // 32) * 32, -(-h // 16) * 16
+    if format == 'yuv':
+        buf = np.frombuffer(data, dtype=np.uint8).copy()
+        y = buf[:pw*ph].reshape(ph, pw)
+        y[:h, :w] = y[:h, :w][::-1, ::-1].copy()
+        uv = buf[pw*ph:pw*ph*3//2].reshape(2, ph//2, pw//2)
+        cw, ch = -(-w // 2), -(-h // 2)
+        uv[:, :ch, :cw] = uv[:, :ch, :cw][:, ::-1, ::-1].copy()
+        return buf.tobytes()
+    if format in RAW_CHANNELS:
+        buf = np.frombuffer(data, dtype=np.uint8).copy().reshape(ph, pw, RAW_CHANNELS[format])
+        buf[:h, :w] = buf[:h, :w][::-1, ::-1].copy()
+        return buf.tobytes()
+    if format not in ('jpeg', 'png', 'gif', 'bmp'):
+        return data
+    from PIL import Image
+    buf = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as img:
+        kw = {'quality': quality, 'exif': img.info.get('exif', b'')} if format == 'jpeg' else {}
+        img.transpose(Image.ROTATE_180).save(buf, format, **kw)
+    return buf.getvalue()
+
+class CameraManager:
+    '''
+    The single owner of the PiCamera.
+
+    The camera is opened on demand, warmed up once, and kept open until it has been idle for `idle_timeout` seconds.
+    Video is recorded on splitter ports 1~3, one `Channel` per format/size, and fanned out to `Subscriber`s.
+    The sensor records video at `video_resolution`, or larger if the first stream asks for more, and every stream is resized down from it on the GPU.
+    Stills are taken at `still_resolution` (or the `resolution` capture option). While video is running,
+    they're taken from splitter port 0 with the aspect ratio of the video, never larger than it.
+    Besides MJPEG, 'h264' channels deliver NAL units, and 'gray' and 'yuv' channels deliver unencoded frames as NumPy arrays from a ring of `raw_ring` buffers
+    '''
+    STILL_PORT = 0
+    VIDEO_PORTS = (1, 2, 3)
+
+    def __init__(self, loop, idle_timeout=30, warmup=2, raw_ring=4, still_resolution=(1280, 720), video_resolution=(1280, 960)):
+        self.loop = loop
+        self.still_resolution = tuple(still_resolution) # PiCamera's default without a display
+        self.video_resolution = tuple(video_resolution)
+        self.raw_ring = raw_ring
+        self.idle_timeout = idle_timeout
+        self.warmup = warmup
+        self.cam = None
+        self.channels = {} # splitter port -> Channel
+        self._lock = asyncio.Lock() # held while (re)configuring the camera or its ports, not during captures
+        self._still_lock = asyncio.Lock() # one burst of stills at a time
+        self._flipped_burst = None # a burst taken without the video port, relying on the camera being flipped
+        self._idle_handle = None
+        self._busy = 0
+
+    async def _run(self, fn, *args, **kw):
+        # picamera calls block, run them in the default executor
+        return await self.loop.run_in_executor(None, functools.partial(fn, *args, **kw))
+
+    @property
+    def is_open(self):
+        return self.cam is not None and not self.cam.closed
+
+    async def _open(self, resolution=None, framerate=None):
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if not self.is_open:
+            import picamera
+            kw = {}
+            resolution and kw.update(resolution=resolution)
+            framerate and kw.update(framerate=framerate)
+            self.cam = await self._run(picamera.PiCamera, **kw)
+            await asyncio.sleep(self.warmup)
+        elif not self.channels and not self._busy and (resolution and tuple(self.cam.resolution) != resolution or framerate and self.cam.framerate != framerate):
+            def reconfigure():
+                resolution and setattr(self.cam, 'resolution', resolution)
+                framerate and setattr(self.cam, 'framerate', framerate)
+            await self._run(reconfigure)
+
+    def _schedule_idle(self):
+        if not self.channels and not self._busy and self.is_open:
+            self._idle_handle and self._idle_handle.cancel()
+            self._idle_handle = self.loop.call_later(self.idle_timeout, lambda: self.loop.create_task(self._close_if_idle()))
+
+    async def _close_if_idle(self):
+        async with self._lock:
+            if not self.channels and not self._busy and self.is_open:
+                await self._run(self.cam.close)
+
+    async def close(self):
+        async with self._lock:
+            if self.is_open:
+                for port in list(self.channels):
+                    await self._run(self.cam.stop_recording, splitter_port=port)
+                await self._run(self.cam.close)
+            self.channels.clear()
+
+    async def subscribe(self, resolution, framerate, format='mjpeg', resize=None, **options):
+        '''
+        subscribe to video at `resolution` (`resize` if given), resized down from the resolution the camera records at.
+        If that's smaller because other video is already running, the video is as large as fits in it with the same aspect ratio.
+        `format` is 'mjpeg', 'h264', 'gray' or 'yuv'
+        '''
+        resolution = tuple(resolution)
+        async with self._lock:
+            # the camera is only reconfigured while no video is recording
+            await self._open(tuple(max(a, b) for a, b in zip(resolution, self.video_resolution)), framerate)
+            size = tuple(self.cam.resolution)
+            resize = fit(tuple(resize or resolution), size)
+            resize = None if resize == size else resize
+            channel = next((c for c in self.channels.values() if c.match(format, resize, options)), None)
+            if channel is None:
+                channel = await self._start_channel(format, resize, options)
+            elif format == 'h264':
+                # a new H.264 subscriber can only start from a key frame, ask for one now rather than wait for the next intra period
+                self.cam.request_key_frame(splitter_port=channel.port)
+            if format == 'h264':
+                sub = StreamSubscriber(channel, functools.partial(self.cam.request_key_frame, splitter_port=channel.port))
+            else:
+                sub = Subscriber(channel)
+            channel.subscribers.append(sub)
+            return sub
+
+    async def _start_channel(self, format, resize, options):
+        port = next((p for p in CameraManager.VIDEO_PORTS if p not in self.channels), None)
+        if port is None:
+            raise RuntimeError('Too many different video streams at the same time')
+        if not self.channels:
+            if self._flipped_burst:
+                await asyncio.wait([self._flipped_burst])
+            self.cam.hflip = self.cam.vflip = False
+        channel = Channel(self.loop, port, format, resize, options, resize or tuple(self.cam.resolution), self.raw_ring,
+                          functools.partial(capture_time, self.cam, port))
+        await self._run(self.cam.start_recording, channel.output, format=channel.record_format, splitter_port=port, resize=resize, **options)
+        self.channels[port] = channel
+        return channel
+
+    def unsubscribe(self, sub):
+        '''returns the task stopping the channel if `sub` was its last subscriber, await it to be sure the port is free'''
+        channel = sub.channel
+        channel.subscribers.remove(sub)
+        if not channel.subscribers:
+            return self.loop.create_task(self._stop_channel(channel))
+
+    async def _stop_channel(self, channel):
+        async with self._lock:
+            if channel.subscribers or self.channels.get(channel.port) is not channel:
+                return
+            del self.channels[channel.port]
+            await self._run(self.cam.stop_recording, splitter_port=channel.port)
+            self._schedule_idle()
+
+    async def capture(self, **options):
+        '''take a still, from the video port if video is running so that recording is not interrupted'''
+        return (await self.capture_sequence(1, **options))[0][1]
+
+    async def capture_sequence(self, n, interval=0, **options):
+        '''
+        take `n` stills `interval` seconds apart in a worker thread, returns a list of (time, data),
+        time being `time.monotonic()` when each capture started
+        '''
+        resolution = tuple(options.pop('resolution', None) or self.still_resolution)
+        async with self._still_lock:
+            async with self._lock:
+                # reconfigures the camera if it's warm from a video stream that has ended
+                await self._open(resolution)
+                self._busy += 1
+                streaming = bool(self.channels)
+                if streaming:
+                    options.update(use_video_port=True, splitter_port=CameraManager.STILL_PORT)
+                    size = tuple(self.cam.resolution)
+                    size != fit(size, resolution) and options.setdefault('resize', fit(size, resolution))
+                    size = tuple(options.get('resize') or size)
+                else:
+                    self.cam.hflip = self.cam.vflip = True
+            # video can be subscribed to/unsubscribed from during the burst, `_busy` keeps the camera open and configured
+            burst = asyncio.ensure_future(self._run(self._capture_sequence, n, interval, options))
+            streaming or setattr(self, '_flipped_burst', burst)
+            try:
+                shots = await burst
+                if streaming:
+                    rotate = functools.partial(rotate180, format=options.get('format', 'jpeg'), size=size, quality=options.get('quality', 85))
+                    shots = await self._run(lambda: [(t, rotate(d)) for t, d in shots])
+                return shots
+            finally:
+                self._flipped_burst = None
+                self._busy -= 1
+                self._schedule_idle()
+
+    def _capture_sequence(self, n, interval, options):
+        shots = []
+        def outputs():
+            start = time.monotonic()
+            for i in range(n):
+                delay = start + i * interval - time.monotonic()
+                delay > 0 and time.sleep(delay)
+                buf = io.BytesIO()
+                shots.append((time.monotonic(), buf))
+                yield buf
+        if n == 1:
+            self.cam.capture(next(outputs()), **options)
+        else:
+            self.cam.capture_sequence(outputs(), **options)
+        return [(t, buf.getvalue()) for t, buf in shots]
@@ -0,0 +1,95 @@
+import functools
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageColor, ImageChops
+from . import util
+from .image_codec import rgb565, rgb
+
+# drawing is done in landscape, like the images shown by `splash_screen`
+WIDTH, HEIGHT = 240, 135
+
+@functools.lru_cache(maxsize=16)
+def font(size):
+    return ImageFont.truetype(util.static('DejaVuSans.ttf'), size)
+
+@functools.lru_cache(maxsize=256)
+def glyphs(text, size):
+    '''`text` rendered into a mask, along with the offset of the mask from the text origin'''
+    left, top, right, bottom = font(size).getbbox(text)
+    mask = Image.new('L', (max(1, right-left), max(1, bottom-top)))
+    ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font(size))
+    return mask, left, top
+
+def color(c):
+    if isinstance(c, str):
+        return ImageColor.getrgb(c)
+    return tuple(c) if isinstance(c, (list, tuple)) else c
+
+def opaque(c):
+    # what the alpha channel is drawn with for color `c`
+    return None if c is None else 255
+
+class Canvas:
+    '''
+    A landscape RGBA overlay composed from drawing commands, laid over whatever else is on the screen
+    (face, animations, `display`) by `DisplayWorker.overlay`. What's not drawn on is transparent.
+    Each command returns the box it has drawn on, and only that region is pushed to the screen
+    '''
+    def __init__(self, display_worker):
+        self.display_worker = display_worker
+        self.image = Image.new('RGB', (WIDTH, HEIGHT))
+        self.alpha = Image.new('L', (WIDTH, HEIGHT))
+        self._draw = ImageDraw.Draw(self.image)
+        self._draw_alpha = ImageDraw.Draw(self.alpha)
+
+    def text(self, text, x, y, size=20, fill='white'):
+        mask, left, top = glyphs(text, size)
+        box = (x+left, y+top, x+left+mask.width, y+top+mask.height)
+        # the glyph edges are left partly transparent in the alpha channel, so they blend with what's under them
+        self.image.paste(color(fill), box, mask.point(lambda v: 255 if v else 0))
+        self.alpha.paste(ImageChops.lighter(self.alpha.crop(box), mask), box)
+        return box
+
+    def line(self, xy, fill='white', width=1):
+        self._draw.line([tuple(p) for p in xy], fill=color(fill), width=width)
+        self._draw_alpha.line([tuple(p) for p in xy], fill=255, width=width)
+        xs, ys = [p[0] for p in xy], [p[1] for p in xy]
+        return (min(xs)-width, min(ys)-width, max(xs)+width+1, max(ys)+width+1)
+
+    def rectangle(self, box, fill=None, outline=None, width=1):
+        self._draw.rectangle(tuple(box), fill=color(fill), outline=color(outline), width=width)
+        self._draw_alpha.rectangle(tuple(box), fill=opaque(fill), outline=opaque(outline), width=width)
+        return (box[0], box[1], box[2]+1, box[3]+1)
+
+    def circle(self, center, radius, fill=None, outline=None, width=1):
+        x, y = center
+        box = (x-radius, y-radius, x+radius, y+radius)
+        self._draw.ellipse(box, fill=color(fill), outline=color(outline), width=width)
+        self._draw_alpha.ellipse(box, fill=opaque(fill), outline=opaque(outline), width=width)
+        return (box[0], box[1], box[2]+1, box[3]+1)
+
+    def image(self, pixels, x, y):
+        # `pixels` is a RGB565 array in screen orientation, e.g. the first frame of an animation
+        img = Image.fromarray(rgb(np.rot90(pixels, -1)))
+        self.image.paste(img, (x, y))
+        self.alpha.paste(255, (x, y, x+img.width, y+img.height))
+        return (x, y, x+img.width, y+img.height)
+
+    def clear(self, fill=None, box=None):
+        '''make `box` (the whole canvas if None) transparent again, or opaque `fill`'''
+        box = box or (0, 0, WIDTH-1, HEIGHT-1)
+        if fill is not None:
+            return self.rectangle(box, fill=fill)
+        self._draw.rectangle(tuple(box), fill=0)
+        self._draw_alpha.rectangle(tuple(box), fill=0)
+        return (box[0], box[1], box[2]+1, box[3]+1)
+
+    def present(self, box):
+        '''push the region `box` (left, top, right, bottom), right/bottom exclusive, to the screen'''
+        left, top = max(0, int(box[0])), max(0, int(box[1]))
+        right, bottom = min(WIDTH, int(np.ceil(box[2]))), min(HEIGHT, int(np.ceil(box[3])))
+        if left >= right or top >= bottom:
+            return
+        pixels = rgb565(np.asarray(self.image)[top:bottom, left:right])
+        alpha = np.asarray(self.alpha)[top:bottom, left:right]
+        # rotate to screen orientation the same way `Screen.display` in cozmars.js does
+        self.display_worker.overlay(np.rot90(pixels), np.rot90(alpha), top, WIDTH-right)
@@ -1,10 +1,24 @@
-import asyncio, time
+import asyncio, time, contextlib
 from collections.abc import Iterable
-from gpiozero import Motor, Button, LineSensor#, TonalBuzzer, DistanceSensor
+from gpiozero import Motor#, TonalBuzzer, DistanceSensor
 from .distance_sensor import DistanceSensor
+from .input_hub import InputHub
+from .sensor_history import SensorHistory
+from .telemetry import stream as telemetry_stream
 from gpiozero.tones import Tone
 from .rcute_servokit import ServoKit
-from . import util
+from .framebuffer import FrameBuffer, DisplayWorker
+from .animation import Animation
+from .cache import LRUCache
+from .face import Face
+from .canvas import Canvas
+from .camera import CameraManager, VideoStream, Channel
+from .motion import MotionScheduler, EASINGS
+from .timeline import Timeline
+from .sound import Sound
+from .ring_buffer import ByteRing
+from .reflex import Reflexes
+from . import util, image_codec, animation, face, audio_codec
 
 import board
 import digitalio
@@ -22,15 +36,16 @@ class CozmarsServer:
         self.rmotor = Motor(*self.conf['motor']['right'])
         # self.reset_servos()
         self.reset_motors()
-        self.lir = LineSensor(self.conf['ir']['left'], queue_len=3, sample_rate=10, pull_up=True)
-        self.rir = LineSensor(self.conf['ir']['right'], queue_len=3, sample_rate=10, pull_up=True)
+        self.lir = self.inputs.line_sensor(self.conf['ir']['left'], debounce=.01)
+        self.rir = self.inputs.line_sensor(self.conf['ir']['right'], debounce=.01)
         sonar_cfg = self.conf['sonar']
         self.sonar = DistanceSensor(trigger=sonar_cfg['trigger'], echo=sonar_cfg['echo'], max_distance=sonar_cfg['max'], threshold_distance=sonar_cfg['threshold'], queue_len=5, partial=True)
 
         self._sensor_event_queue = None
         self._button_last_press_time = 0
+        self._sensor_events_dropped = 0
         def cb(ev, obj, attr):
-            return lambda: self._sensor_event_queue and self.event_loop.call_soon_threadsafe(self._sensor_event_queue.put_nowait, (ev, getattr(obj, attr)))
+            return lambda: self._sensor_event(ev, getattr(obj, attr), obj.timestamp)
         def button_press_cb():
             if self._sensor_event_queue:
                 now = time.time()
@@ -38,24 +53,38 @@ class CozmarsServer:
                     ev = 'double_pressed'
                 else:
                     ev = 'pressed'
-                self.event_loop.call_soon_threadsafe(self._sensor_event_queue.put_nowait, (ev, True))
+                self._sensor_event(ev, True, self.button.timestamp)
                 self._button_last_press_time = now
         self.lir.when_line = self.lir.when_no_line = cb('lir', self.lir, 'value')
         self.rir.when_line = self.rir.when_no_line = cb('rir', self.rir, 'value')
+        self.inputs.when_changed = self._on_inputs_changed
+        self.reflexes.on_ir(self.lir.value, self.rir.value)
         self.button.hold_time = 1
         self.button.when_pressed = button_press_cb
         self.button.when_released = cb('pressed', self.button, 'is_pressed')
         self.button.when_held = cb('long_pressed', self.button, 'is_held')
         self.sonar.when_in_range = cb('in_range', self.sonar, 'distance')
         self.sonar.when_out_of_range = cb('out_of_range', self.sonar, 'distance')
-        self.screen.fill(0)
+        self.sonar.when_measured = self._on_distance
+        self.sonar.moving = lambda: bool(self.lmotor.value or self.rmotor.value) # measure more often while moving
+        self.display_worker.clear(0)
+        self.display_worker.reset_stats()
         self._screen_backlight(.01)
 
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
+        self.stop_timeline()
         self.stop_all_motors()
-        for a in [self.sonar, self.lir, self.rir, self.lmotor, self.rmotor, self.cam]:
+        for name in self.reflexes.rules:
+            self.reflexes.set_rule(name, None)
+        self.reflexes.reset()
+        self.stop_animation()
+        self.stop_eyes()
+        self.clear_canvas()
+        await self.display_worker.vsync()
+        self.inputs.when_changed = None
+        for a in [self.sonar, self.lir, self.rir, self.lmotor, self.rmotor]:
             a and a.close()
         self._screen_backlight(None)
         self._speaker_power(None)
@@ -63,6 +92,8 @@ class CozmarsServer:
 
     def __del__(self):
         self.button.close()
+        self.inputs.close()
+        self.display_worker.close()
 
     def __init__(self, conf_path=util.CONF, env_path=util.ENV):
         with open(conf_path) as cf:
@@ -76,9 +107,10 @@ class CozmarsServer:
         self.mic_int = False
         self.event_loop = asyncio.get_running_loop()
 
-        self.button = Button(self.conf['button'])
+        self.inputs = InputHub(self.event_loop)
+        self.button = self.inputs.button(self.conf['button'])
         self._double_press_threshold = .5
-        self.cam = None
+        self.camera_manager = CameraManager(self.event_loop)
 
         spi = board.SPI()
         cs_pin = digitalio.DigitalInOut(getattr(board, f'D{self.conf["screen"]["cs"]}'))
@@ -90,6 +122,24 @@ class CozmarsServer:
             rst=reset_pin,
             baudrate=24000000,
         )
+        self.framebuffer = FrameBuffer(self.screen, 135, 240)
+        self.display_worker = DisplayWorker(self.framebuffer, self.event_loop)
+        self.animations = LRUCache(4 << 20, 'Animation')
+        self._animation_task = None
+        self._face_task = None
+        self.canvas = Canvas(self.display_worker)
+        self.sounds = LRUCache(2 << 20, 'Sound')
+        self.history = SensorHistory(('lir', 'rir', 'button', 'sonar'))
+        self._timeline_task = None
+
+        # created before the servos are set up, relaxing them goes through it
+        self.motion = MotionScheduler(self.conf['servo']['update_rate'], self._servo_batch)
+        self.reflexes = Reflexes(lambda: self.mapped_speed((self.lmotor.value, self.rmotor.value)),
+                                 lambda sp: self._set_speed(self.real_speed(sp)), self._sensor_event)
+        self.motion.add('speed', lambda: (self.lmotor.value, self.rmotor.value), self._set_speed, self._limit_speed)
+        self.motion.add('lift', lambda: self.larm.fraction, self._set_lift)
+        self.motion.add('head', lambda: self._head.angle, self._set_head)
+        self.motion.add('backlight', lambda: self.screen_backlight.fraction or 0, self._screen_backlight)
 
         try: # the try-catch is for testing the server without servo driver connected
             self.servokit = ServoKit(channels=16, freq=self.conf['servo']['freq'])
@@ -110,6 +160,9 @@ class CozmarsServer:
         except Exception as e:
             print(e)
 
+    def _servo_batch(self):
+        return self.servokit.batch() if hasattr(self, 'servokit') else contextlib.nullcontext()
+
     @staticmethod
     def conf_servo(servokit, conf):
         servo = servokit.servo[conf['channel']]
@@ -179,27 +232,30 @@ class CozmarsServer:
         sp = (((s-((.2 if s>0 else -.2)))/.8 if s else 0) for s in sp)
         return tuple(max(-1, min(1, s/self.motor_compensate['forward' if s>0 else 'backward'][i])) for i, s in enumerate(sp))
 
-    async def speed(self, speed=None, duration=None):
+    async def speed(self, speed=None, duration=None, easing='linear', queue=False):
         if speed is None:
             return self.mapped_speed((self.lmotor.value, self.rmotor.value))
         speed = self.real_speed(speed)
-        while (self.lmotor.value, self.rmotor.value) != speed:
-            linc = speed[0] - self.lmotor.value
-            if 0< abs(linc) < .3:
-                self.lmotor.value = speed[0]
-            elif linc:
-                self.lmotor.value += .3 if linc> 0 else -.3
-            rinc = speed[1] - self.rmotor.value
-            if 0 < abs(rinc) < .3:
-                self.rmotor.value = speed[1]
-            elif rinc:
-                self.rmotor.value += .3 if rinc> 0 else -.3
-            await asyncio.sleep(.05)
+        # motors change by .3 every .05 sec at most
+        ramp = max(abs(a - b) for a, b in zip(speed, (self.lmotor.value, self.rmotor.value))) / 6
+        await self.motion.move('speed', speed, ramp, easing, queue)
         if duration:
+            seq = self.motion.seq('speed')
             await asyncio.sleep(duration)
-            await self.speed((0, 0))
+            if seq == self.motion.seq('speed'): # not overridden by another command meanwhile
+                await self.speed((0, 0))
+
+    def _set_speed(self, speed):
+        self.lmotor.value, self.rmotor.value = speed
+
+    def _limit_speed(self, speed):
+        mapped = self.mapped_speed(speed)
+        limited = self.reflexes.limit(mapped)
+        return speed if limited is mapped else self.real_speed(limited)
 
     def stop_all_motors(self):
+        self.motion.stop()
+        self.reflexes.follow(None)
         self.lmotor.value = self.rmotor.value = 0
         if hasattr(self, 'servokit'):
             self.relax_lift()
@@ -213,128 +269,373 @@ class CozmarsServer:
         if hasattr(self, 'servokit'):
             self.speaker_power.fraction = b
 
-    async def _servo(self, servo, *args):
+    async def _move(self, name, value, duration, speed, max_speed, easing, queue):
+        if speed:
+            if not 0 < speed <= max_speed * self.servo_update_rate:
+                raise ValueError(f'Speed must be 0 ~ {max_speed*self.servo_update_rate}')
+            duration = abs(value - self.motion.actuators[name].read())/speed
+        await self.motion.move(name, value, duration, easing, queue)
+
+    async def _servo(self, name, servo, *args, easing='linear', queue=False):
         if not args:
             return servo.fraction or 0
         value = args[0]
-        duration = speed = None
-        try:
-            duration = args[1]
-            speed = args[2]
-        except IndexError:
-            pass
+        if value is not None and not 0 <= value <= 1:
+            raise ValueError(f'{name.capitalize()} must be 0 to 1')
+        duration, speed = (list(args[1:3]) + [None, None])[:2]
         if not (duration or speed):
-            servo.fraction = value or 0
+            self.motion.set(name, value or 0)
             return
-        elif speed:
-            if not 0 < speed <= 1 * self.servo_update_rate:
-                raise ValueError(f'Speed must be 0 ~ {1*self.servo_update_rate}')
-            duration = abs(value - servo.fraction)/speed
-        steps = int(duration * self.servo_update_rate)
-        interval = 1/self.servo_update_rate
-        try:
-            inc = (value-servo.fraction)/steps
-            for _ in range(steps):
-                await asyncio.sleep(interval)
-                servo.fraction += inc
-        except (ZeroDivisionError, ValueError):
-            pass
-        finally:
-            servo.fraction = value
+        await self._move(name, value, duration, speed, 1, easing, queue)
 
-    async def backlight(self, *args):
-        return await self._servo(self.screen_backlight, *args)
+    async def backlight(self, *args, easing='linear', queue=False):
+        return await self._servo('backlight', self.screen_backlight, *args, easing=easing, queue=queue)
 
     def relax_lift(self):
+        self.motion.stop('lift')
         self.larm.relax()
         self.rarm.relax()
 
     def relax_head(self):
+        self.motion.stop('head')
         self._head.relax()
 
-    async def lift(self, *args):
+    def _set_lift(self, height):
+        self.rarm.fraction = self.larm.fraction = height
+
+    async def lift(self, *args, easing='linear', queue=False):
+        '''
+        `lift(height, duration, speed)`, the arms move with `easing` (see `motion.EASINGS`),
+        a new move interrupts the current one, unless `queue` is True, then it starts after the current one
+        '''
         if not args:
             return self.rarm.fraction
         height = args[0]
         if height == None:
-            self.rarm.fraction = self.larm.fraction = height
+            self.motion.set('lift', None)
             return
         if not 0<= height <= 1:
             raise ValueError('Height must be 0 to 1')
-        duration = speed = None
-        try:
-            duration = args[1]
-            speed = args[2]
-        except IndexError:
-            pass
+        duration, speed = (list(args[1:3]) + [None, None])[:2]
         if not (self.rarm.fraction!=None and (speed or duration)):
-            self.rarm.fraction = height
-            self.larm.fraction = height
+            self.motion.set('lift', height)
             return
-        elif speed:
-            if not 0 < speed <= 1 * self.servo_update_rate:
-                raise ValueError(f'Speed must be 0 ~ {1*self.servo_update_rate}')
-            duration = abs(height - self.larm.fraction)/speed
-        steps = int(duration * self.servo_update_rate)
-        interval = 1/self.servo_update_rate
-        try:
-            inc = (height-self.larm.fraction)/steps
-            for _ in range(steps):
-                await asyncio.sleep(interval)
-                self.larm.fraction += inc
-                self.rarm.fraction += inc
-        except (ZeroDivisionError, ValueError):
-            pass
-        finally:
-            self.rarm.fraction = height
-            self.larm.fraction = height
+        await self._move('lift', height, duration, speed, 1, easing, queue)
+
+    def _set_head(self, angle):
+        self._head.angle = angle
 
-    async def head(self, *args):
+    async def head(self, *args, easing='linear', queue=False):
+        '''`head(angle, duration, speed)`, see `lift` for `easing` and `queue`'''
         if not args:
             return self._head.angle
         angle = args[0]
         if angle == None:
-            self._head.angle = None
+            self.motion.set('head', None)
             return
         if not self._head._start_angle <= angle <= self._head._end_angle:
-            raise ValueError('Angle out of range [{self._head._start_angle}, {self._head._end_angle}]')
-        duration = speed = None
-        try:
-            duration = args[1]
-            speed = args[2]
-        except IndexError:
-            pass
+            raise ValueError(f'Angle out of range [{self._head._start_angle}, {self._head._end_angle}]')
+        duration, speed = (list(args[1:3]) + [None, None])[:2]
         if not (self._head.angle!=None and (speed or duration)):
-            self._head.angle = angle
+            self.motion.set('head', angle)
             return
-        elif speed:
-            if not 0 < speed <= 80 * self.servo_update_rate:
-                raise ValueError(f'Speed must be 0 ~ {80*self.servo_update_rate}')
-            duration = abs(angle - self._head.angle)/speed
-        steps = int(duration*self.servo_update_rate)
-        interval = 1/self.servo_update_rate
-        try:
-            inc = (angle-self._head.angle)/steps
-            for _ in range(steps):
-                await asyncio.sleep(interval)
-                self._head.angle += inc
-        except (ZeroDivisionError, ValueError):
-            pass
-        finally:
-            self._head.angle = angle
+        await self._move('head', angle, duration, speed, 80, easing, queue)
 
     def display(self, image_data, x, y, x1, y1):
-        self.screen._block(x, y, x1, y1, image_data)
+        self.display_worker.display(image_data, x, y, x1, y1)
+
+    def display_encoded(self, data, format, x, y, x1, y1, palette=None, bits=8):
+        # see `image_codec` for supported formats
+        self.display_worker.draw(image_codec.decode(data, format, x1-x+1, y1-y+1, palette, bits), x, y)
+
+    async def display_stream(self, fps, format=None, palette=None, bits=8, buffer=3, *, request_stream):
+        '''
+        present frames from `request_stream` at a fixed `fps`,
+        each frame is `[image_data, x, y, x1, y1]` as for `display`, or encoded data as for `display_encoded` if `format` is given.
+        At most `buffer` frames are kept, when frames arrive faster than they're presented or the presenting falls behind,
+        the oldest ones are dropped instead of building up latency
+        '''
+        if not 0 < fps:
+            raise ValueError('fps must be positive')
+        if not 0 < buffer:
+            raise ValueError('buffer must be positive')
+        from collections import deque
+        loop = asyncio.get_running_loop()
+        frames = deque()
+        arrived = asyncio.Event()
+        ended = False
+        presented = dropped = 0
+
+        async def receive():
+            nonlocal ended, dropped
+            while True:
+                frame = await request_stream.get()
+                if isinstance(frame, Exception):
+                    # StopAsyncIteration at the end of the stream, or an error from the client
+                    isinstance(frame, StopAsyncIteration) or print('[display_stream]', repr(frame))
+                    ended = True
+                    arrived.set()
+                    return
+                if len(frames) == buffer:
+                    frames.popleft()
+                    dropped += 1
+                frames.append(frame)
+                arrived.set()
+
+        def receive_done(task):
+            # an unexpected error ends the stream, rather than leave the presenting loop waiting for frames forever
+            nonlocal ended
+            if not task.cancelled() and task.exception():
+                print('[display_stream]', repr(task.exception()))
+                ended = True
+                arrived.set()
+
+        recv_task = asyncio.create_task(receive())
+        recv_task.add_done_callback(receive_done)
+        interval = 1/fps
+        next_t = loop.time()
+        try:
+            while not (ended and not frames):
+                if not frames:
+                    # starved: wait for the stream to refill the jitter buffer, then restart the clock
+                    arrived.clear()
+                    while len(frames) < min(2, buffer) and not ended:
+                        await arrived.wait()
+                        arrived.clear()
+                    next_t = loop.time()
+                    continue
+                frame = frames.popleft()
+                if format:
+                    self.display_encoded(frame[0], format, *frame[1:5], palette, bits)
+                else:
+                    self.display(*frame[:5])
+                presented += 1
+                next_t += interval
+                late = loop.time() - next_t
+                if late > 0:
+                    # skip the missed ticks along with the frames that were due on them
+                    missed = int(late / interval) + 1
+                    next_t += missed * interval
+                    for _ in range(min(missed, len(frames) - 1)):
+                        frames.popleft()
+                        dropped += 1
+                await asyncio.sleep(next_t - loop.time())
+        finally:
+            recv_task.cancel()
+        return {'presented': presented, 'dropped': dropped}
 
     def fill(self, color565, x, y, w, h):
-        self.screen.fill_rectangle(x, y, w, h, color565)
+        self.display_worker.fill(color565, x, y, w, h)
+
+    def pixel(self, x, y, color565=None):
+        return self.display_worker.pixel(x, y, color565)
+
+    async def vsync(self):
+        return await self.display_worker.vsync()
+
+    def display_stats(self, reset=False):
+        stats = self.display_worker.stats()
+        reset and self.display_worker.reset_stats()
+        return stats
+
+    async def load_animation(self, data, width, height, format=None, durations=100, palette=None, bits=8):
+        '''
+        convert an animated GIF/APNG (if `format` is None) or a list of frames encoded in `format` (see `display_encoded`)
+        to RGB565 once and cache it, returns the key to play it with.
+        `durations` in milliseconds is a list with one per frame, or a number for all of them,
+        for GIF/APNG it's a number, the default for frames without timing
+        '''
+        if format is None:
+            if not isinstance(durations, (int, float)) or durations <= 0:
+                raise ValueError('durations must be a positive number for GIF/APNG')
+            key = LRUCache.key(data, width, height, durations)
+            load = lambda: Animation.from_image(data, width, height, durations)
+        else:
+            key = LRUCache.key(*data, format, width, height, durations, palette, bits)
+            load = lambda: Animation.from_frames(data, format, width, height, durations, palette, bits)
+        if key not in self.animations:
+            self.animations[key] = await asyncio.get_running_loop().run_in_executor(None, load)
+        return key
+
+    def has_animation(self, key):
+        return key in self.animations
+
+    async def play_animation(self, key, x=0, y=0, loop=1):
+        '''play a cached animation `loop` times (0 for forever), returns False if it's stopped before finishing'''
+        anim = self.animations[key]
+        self.framebuffer._check_region(x, y, x+anim.width-1, y+anim.height-1)
+        self.stop_animation()
+        self.stop_eyes()
+        task = self._animation_task = asyncio.create_task(animation.play(anim, self.display_worker, x, y, loop))
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task.cancelled():
+            return False
+        task.result() # raise the exception if any
+        return True
+
+    def stop_animation(self):
+        self._animation_task and self._animation_task.cancel()
+
+    def eyes(self, open=None, gaze=None, squint=None, color=None, transition=.2, blink_interval=None):
+        '''
+        draw the eyes on the robot, they move from the current look to the given one in `transition` seconds.
+        `open` and `squint` are 0 ~ 1, `gaze` is (x, y) each -1 ~ 1,
+        `blink_interval` in seconds turns on auto blinking, 0 turns it off
+        '''
+        target = {}
+        if open is not None:
+            if not 0 <= open <= 1:
+                raise ValueError('open must be 0 ~ 1')
+            target['open'] = open
+        if squint is not None:
+            if not 0 <= squint <= 1:
+                raise ValueError('squint must be 0 ~ 1')
+            target['squint'] = squint
+        if gaze is not None:
+            if len(gaze) != 2 or not all(-1 <= g <= 1 for g in gaze):
+                raise ValueError('gaze must be (x, y), each -1 ~ 1')
+            target['gaze_x'], target['gaze_y'] = gaze
+        if not transition >= 0:
+            raise ValueError('transition must be >= 0')
+        if blink_interval is not None and not blink_interval >= 0:
+            raise ValueError('blink_interval must be >= 0')
+        color = None if color is None else face.to_color565(color)
+        # only take over the screen once the arguments are known to be valid
+        if self._face_task is None or self._face_task.done():
+            self.stop_animation()
+            self.face = Face(self.env.get('eye_color', 'cyan'))
+            self._face_task = asyncio.create_task(face.run(self.face, self.display_worker))
+        self.face.set(transition, **target)
+        if color is not None:
+            self.face.set_color(color)
+        if blink_interval is not None:
+            self.face.blink_interval = blink_interval
+
+    def blink(self):
+        self._face_task and not self._face_task.done() and self.face.blink()
+
+    def stop_eyes(self):
+        self._face_task and self._face_task.cancel()
+
+    def draw(self, commands):
+        '''
+        run a list of drawing commands `[name, *args]` on the canvas, an overlay that stays on top of the eyes, animations and `display`,
+        and push the region they cover to the screen at once,
+        `name` is one of 'text', 'line', 'rectangle', 'circle', 'image' and 'clear', see the `draw_*` methods for their arguments.
+        Coordinates are in landscape (240x135)
+        '''
+        box = None
+        for name, *args in commands:
+            if name == 'image':
+                key, *args = args
+                args = [self.animations[key].first, *args]
+            elif name not in ('text', 'line', 'rectangle', 'circle', 'clear'):
+                raise ValueError(f'Unknown drawing command {name}')
+            b = getattr(self.canvas, name)(*args)
+            box = b if box is None else (min(box[0], b[0]), min(box[1], b[1]), max(box[2], b[2]), max(box[3], b[3]))
+        box and self.canvas.present(box)
+
+    def draw_text(self, text, x, y, size=20, fill='white'):
+        self.draw([['text', text, x, y, size, fill]])
+
+    def draw_line(self, xy, fill='white', width=1):
+        self.draw([['line', xy, fill, width]])
+
+    def draw_rectangle(self, box, fill=None, outline=None, width=1):
+        self.draw([['rectangle', box, fill, outline, width]])
+
+    def draw_circle(self, center, radius, fill=None, outline=None, width=1):
+        self.draw([['circle', center, radius, fill, outline, width]])
+
+    def draw_image(self, key, x, y):
+        # `key` of an image loaded by `load_animation`
+        self.draw([['image', key, x, y]])
+
+    def clear_canvas(self, fill=None, box=None):
+        # transparent again unless `fill` is given
+        self.draw([['clear', fill, box]])
+
+    def load_sound(self, data, samplerate, dtype='int16'):
+        '''keep a mono PCM clip on the robot to be played by `play_sound` or a timeline, returns its key'''
+        if dtype not in ('int8', 'int16', 'int32', 'float32'):
+            raise ValueError('dtype must be int8, int16, int32 or float32')
+        key = LRUCache.key(data, samplerate, dtype)
+        if key not in self.sounds:
+            self.sounds[key] = Sound(data, samplerate, dtype)
+        return key
+
+    def has_sound(self, key):
+        return key in self.sounds
+
+    async def play_sound(self, key, volume=None, blocksize=1600):
+        sound = self.sounds[key]
+        await self.speaker(sound.samplerate, sound.dtype, blocksize, volume, request_stream=sound.stream(blocksize))
+
+    def _check_timeline_action(self, name, args, kwargs):
+        if kwargs.get('easing', 'linear') not in EASINGS:
+            raise ValueError(f'easing must be one of {list(EASINGS)}')
+        value = args[0] if args else None
+        if name == 'speed':
+            sp = value if isinstance(value, Iterable) else (value, value)
+            if value is None or not (len(sp) == 2 and all(-1 <= s <= 1 for s in sp)):
+                raise ValueError('speed must be -1 ~ 1, or a pair of them')
+        elif name in ('lift', 'backlight', 'head'):
+            low, high, max_speed = (self._head._start_angle, self._head._end_angle, 80) if name == 'head' else (0, 1, 1)
+            if value is not None and not low <= value <= high:
+                raise ValueError(f'{name} must be {low} ~ {high}')
+            if len(args) > 2 and args[2] and not 0 < args[2] <= max_speed * self.servo_update_rate:
+                raise ValueError(f'Speed must be 0 ~ {max_speed*self.servo_update_rate}')
+        elif name == 'display':
+            anim = self.animations[value]
+            x, y = (list(args[1:3]) + [0, 0])[:2]
+            self.framebuffer._check_region(x, y, x+anim.width-1, y+anim.height-1)
+        elif name == 'speaker':
+            self.sounds[value]
+
+    async def timeline(self, actions, loop=1, period=None):
+        '''
+        run a choreography on the robot against its own clock, `actions` is a list of `[t, name, *args]`
+        to be run `t` seconds after the start, see `timeline.Timeline`. `name` is one of
+
+        * 'speed', 'lift', 'head', 'backlight': with the arguments of the methods of the same names
+        * 'display': `key, x, y, loop` of an animation or image loaded by `load_animation`, see `play_animation`
+        * 'speaker': `key, volume` of a sound loaded by `load_sound`, see `play_sound`
 
-    def pixel(self, x, y, color565):
-        return self.screen.pixel(x, y, color565)
+        The whole timeline is checked before it starts. It's run `loop` times (0 for forever), every `period` seconds,
+        or right after the previous pass has finished if `period` is None.
+        Yields progress events as `Timeline.run` emits them, then `['done', passes]`, or `['stopped']` if `stop_timeline` is called.
+        Only one timeline runs at a time, a new one stops the current one
+        '''
+        tl = Timeline(actions, {'speed': self.speed, 'lift': self.lift, 'head': self.head, 'backlight': self.backlight,
+                                'display': self.play_animation, 'speaker': self.play_sound}, self._check_timeline_action)
+        if period is not None and not period >= tl.end:
+            raise ValueError(f'period must be >= the time of the last action {tl.end}')
+        self.stop_timeline()
+        events = asyncio.Queue()
+        task = self._timeline_task = asyncio.create_task(tl.run(events.put_nowait, loop, period))
+        task.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while True:
+                ev = await events.get()
+                if ev is None:
+                    break
+                yield ev
+            yield ['stopped'] if task.cancelled() else ['done', task.result()]
+        finally:
+            stopped = not task.done() or task.cancelled()
+            task.cancel()
+            if stopped:
+                # leave the actuators where they are, instead of finishing the moves of a cancelled timeline
+                self.motion.stop()
+                if 'speed' in tl.names:
+                    self.motion.set('speed', (0, 0))
 
-    # def gif(self, gif, loop):
-    #     #https://github.com/adafruit/Adafruit_CircuitPython_RGB_screen/blob/master/examples/rgb_screen_pillow_animated_gif.py
-    #     raise NotImplemented
+    def stop_timeline(self):
+        self._timeline_task and self._timeline_task.cancel()
 
     # async def play(self, *, request_stream):
     #     async for freq in request_stream:
@@ -346,25 +647,103 @@ class CozmarsServer:
     #         await asyncio.sleep(duration)
     #         self.buzzer.stop()
 
-    async def sensor_data(self, update_rate=None):
+    def _sensor_event(self, ev, value, t=None):
+        # thread safe, for sensor callbacks
+        self._sensor_event_queue and self.event_loop.call_soon_threadsafe(self._put_sensor_event, (ev, value, t or time.monotonic()))
+
+    def _put_sensor_event(self, event):
+        queue = self._sensor_event_queue
+        if queue:
+            if queue.full():
+                self._sensor_events_dropped += 1
+            queue.force_put_nowait(event)
+
+    def _on_inputs_changed(self, changed):
+        # in the input thread, reflexes react before the events get to the loop
+        for name, input in (('lir', self.lir), ('rir', self.rir), ('button', self.button)):
+            if input in changed:
+                self.history.record(name, input.timestamp, input.value)
+        if self.lir in changed or self.rir in changed:
+            self.reflexes.on_ir(self.lir.value, self.rir.value)
+
+    def _on_distance(self, distance):
+        # in the sonar thread
+        self.history.record('sonar', self.sonar.timestamp, distance)
+        self.reflexes.on_distance(distance)
+
+    def sensor_history(self, names=None, start=None, end=None):
+        '''
+        readings of sensors `names` ('lir', 'rir', 'button', 'sonar', all if None) between time.monotonic() `start` and `end`,
+        returns `{'now': time.monotonic(), name: bytes}`, the bytes of each sensor are packed records of
+        little-endian float64 time and float32 value (`sensor_history.RECORD`), oldest first
+        '''
+        return {'now': time.monotonic(), **self.history.query(names, start, end)}
+
+    def reflex(self, name, *args):
+        '''
+        get or set the rule of reflex `name`, 'edge' or 'obstacle', None turns it off, see `reflex.Reflexes`.
+        When a rule is triggered or cleared, `sensor_data` yields `('edge', [lir, rir])`/`('edge', None)`
+        or `('obstacle', distance)`/`('obstacle', None)`
+        '''
+        if args:
+            self.reflexes.on_ir(self.lir.value, self.rir.value)
+            self.reflexes.set_rule(name, args[0])
+        else:
+            return self.reflexes.rules[name]
+
+    def line_follow(self, speed=None, turn=.5, line=0):
+        '''
+        follow a line with the IR sensors at `speed` until `line_follow()` or `stop_all_motors` is called,
+        `sensor_data` yields `('line_lost', True)` when both sensors lose the line
+        '''
+        if speed is not None:
+            self.motion.stop('speed')
+        self.reflexes.follow(speed, turn, line)
+        self.reflexes.on_ir(self.lir.value, self.rir.value)
+
+    async def sensor_data(self, update_rate=None, timestamps=False):
+        '''
+        yields `(name, value)` of sensor events, and `('sonar', distance)` every `1/update_rate` seconds without events.
+        With `timestamps`, it's `(name, value, t)`, `t` being when it happened in time.monotonic() on the robot
+        '''
         timeout = 1/update_rate if update_rate else None
+        pick = (lambda ev: ev) if timestamps else (lambda ev: ev[:2])
         try:
-            # if the below queue has a max size, it'd better be a `RPCStream` instead of `asyncio.Queue`,
-            # and call `force_put_nowait` instead of `put_nowait` in `loop.call_soon_threadsafe`,
-            # otherwise if the queue if full,
-            # an `asyncio.QueueFull` exception will be raised inside the main loop!
-            self._sensor_event_queue = asyncio.Queue()
-            yield 'lir', self.lir.value
-            yield 'rir', self.rir.value
+            # bounded, when the client doesn't keep up the oldest events are dropped (and counted, see `sensor_stats`)
+            self._sensor_event_queue = RPCStream(64)
+            yield pick(('lir', self.lir.value, self.lir.timestamp))
+            yield pick(('rir', self.rir.value, self.rir.timestamp))
             while True:
                 try:
-                    yield await asyncio.wait_for(self._sensor_event_queue.get(), timeout)
+                    yield pick(await asyncio.wait_for(self._sensor_event_queue.get(), timeout))
                 except asyncio.TimeoutError:
-                    yield 'sonar', self.sonar.distance
+                    yield pick(('sonar', self.sonar.distance, self.sonar.timestamp))
         except Exception as e:
             self._sensor_event_queue = None
             raise e
 
+    async def telemetry(self, rate=20, keepalive=1, resolution=.01):
+        '''
+        yields the state of all sensors as compact binary frames (see `telemetry.FRAME`) at most `rate` times a second,
+        only when something has changed, or every `keepalive` seconds otherwise. Sonar distance is rounded to `resolution` meters
+        '''
+        if not 0 < rate <= 100:
+            raise ValueError('rate must be 0 ~ 100')
+        def snapshot():
+            state = {'lir': self.lir.value, 'rir': self.rir.value, 'pressed': self.button.is_pressed, 'held': self.button.is_held,
+                     'edge': self.reflexes.edge, 'obstacle': self.reflexes.obstacle, 'following': self.reflexes.following}
+            return state, self.button.presses, self.sonar.timestamp and self.sonar.distance
+        stream = telemetry_stream(snapshot, rate, keepalive, resolution)
+        try:
+            async for frame in stream:
+                yield frame
+        finally:
+            await stream.aclose()
+
+    def sensor_stats(self):
+        '''events dropped by `sensor_data` because the client didn't keep up'''
+        return {'events_dropped': self._sensor_events_dropped}
+
     def double_press_threshold(self, *args):
         if args:
             self._double_press_threshold = args[0]
@@ -412,112 +791,201 @@ class CozmarsServer:
     def speaker_volume(self, value=None):
         return self._volume('PCM', value)
 
+    def clock(self, t=None):
+        '''
+        returns `[t, now]`, `now` being time.monotonic() on the robot, the clock all timestamps
+        (camera frames, microphone blocks, speaker underruns, sensor events) are in.
+        For NTP-style syncing, pass the client's time as `t` and note when the reply arrives as `t1`:
+        rtt = t1 - t, offset = now - (t + t1) / 2, the offset from the reply with the smallest rtt out of a few is the most accurate
+        '''
+        return [t, time.monotonic()]
+
     async def capture(self, options):
-        import picamera, io
-        if self.cam is None or self.cam.closed:
-            self.cam = picamera.PiCamera()
-            self.cam.vflip = self.cam.hflip = True
+        # `standby` is kept for compatibility, the camera now always stays warm for a while after use
         delay = options.pop('delay', 0)
-        standby = options.pop('standby', False)
+        options.pop('standby', None)
+        delay and await asyncio.sleep(delay)
+        return await self.camera_manager.capture(**options)
+
+    async def capture_burst(self, n, interval, options):
+        '''take `n` stills `interval` seconds apart, returns a list of `[timestamp, data]`, see `clock` for the timestamps'''
+        if not 0 < n <= 100:
+            raise ValueError('n must be 1 ~ 100')
+        options.setdefault('format', 'jpeg')
+        options.setdefault('use_video_port', True)
+        return await self.camera_manager.capture_sequence(n, interval, **options)
+
+    async def camera(self, width, height, framerate, bitrate=None, format='jpeg', intra_period=None, timestamps=False):
+        '''
+        stream JPEG frames, or H.264 NAL units if `format` is 'h264'.
+        If `format` is a list of acceptable formats in order of preference, e.g. ['h264', 'jpeg'],
+        the first one that can be started is used, and its name is yielded before any frame.
+        For JPEG, if `bitrate` (bytes per second) is given, quality, size and frame rate are adapted to stay within it,
+        see `camera_stats` for the current settings and drop counts.
+        For H.264, `bitrate` and `intra_period` (frames between key frames) are passed to the encoder.
+        With `timestamps`, `[t, frame]` is yielded instead, `t` being when it was captured, see `clock`
+        '''
+        formats = [format] if isinstance(format, str) else list(format)
+        for i, fmt in enumerate(formats):
+            if fmt == 'h264':
+                opts = {'inline_headers': True}
+                bitrate and opts.update(bitrate=int(bitrate * 8))
+                intra_period and opts.update(intra_period=intra_period)
+                stream = VideoStream(self.camera_manager, (width, height), framerate, bitrate, format='h264', encoder_options=opts)
+            elif fmt == 'jpeg':
+                stream = VideoStream(self.camera_manager, (width, height), framerate, bitrate)
+            else:
+                raise ValueError(f'Unknown format {fmt}, must be jpeg or h264')
+            try:
+                await stream.start()
+                break
+            except Exception:
+                if i == len(formats) - 1:
+                    raise
+        self._camera_stream = stream
         try:
-            buf = io.BytesIO()
-            delay and await asyncio.sleep(delay)
-            self.cam.capture(buf, **options)
-            buf.seek(0)
-            return buf.read()
+            if not isinstance(format, str):
+                yield fmt
+            async for frame in stream:
+                yield [stream.timestamp, frame] if timestamps else frame
         finally:
-            not standby and self.cam.close()
+            stream.close()
 
-    async def camera(self, width, height, framerate):
-        import picamera, io, threading
+    async def camera_raw(self, width, height, framerate, format='gray', compress=False, timestamps=False):
+        '''
+        stream unencoded frames resized to `width`x`height` on the GPU, 'gray' frames are the bare Y plane (width*height bytes),
+        'yuv' frames are YUV420 with the planes padded to multiples of 32x16. Frames are never scaled up, if other video is already
+        recorded at a lower resolution, they're as large as fits in it with the same aspect ratio. With `compress`, frames are zlib compressed.
+        With `timestamps`, `[t, frame]` is yielded instead, see `camera`
+        '''
+        if format not in Channel.RAW_FORMATS:
+            raise ValueError(f'format must be one of {Channel.RAW_FORMATS}')
+        import zlib
+        loop = asyncio.get_running_loop()
+        sub = await self.camera_manager.subscribe((width, height), framerate, format=format, resize=(width, height))
         try:
-            queue = RPCStream(2)
-            stop_ev = threading.Event()
-
-            def bg_run(loop):
-                nonlocal queue, stop_ev, width, height, framerate
-                with picamera.PiCamera(resolution=(width, height), framerate=framerate) as cam:
-                    # Camera warm-up time
-                    time.sleep(2)
-                    stream = io.BytesIO()
-                    for _ in cam.capture_continuous(stream, 'jpeg', use_video_port=True):
-                        if stop_ev.isSet():
-                            break
-                        stream.truncate()
-                        stream.seek(0)
-                        loop.call_soon_threadsafe(queue.force_put_nowait, stream.read())
-                        # queue.put_nowait(stream.read())
-                        stream.seek(0)
-
-            loop = asyncio.get_running_loop()
-            # threading.Thread(target=bg_run, args=[loop]).start()
-            bg_task = loop.run_in_executor(None, bg_run, loop)
-
-            while True:
-                yield await queue.get()
-
+            async for frame in sub:
+                # the frame is a view into the camera's ring buffer, so it's copied out (or compressed) right away
+                t = sub.timestamp
+                data = await loop.run_in_executor(None, zlib.compress, frame.tobytes(), 1) if compress else frame.tobytes()
+                yield [t, data] if timestamps else data
         finally:
-            stop_ev.set()
-            await bg_task
+            self.camera_manager.unsubscribe(sub)
+
+    def camera_stats(self):
+        stream = getattr(self, '_camera_stream', None)
+        return stream and stream.stats()
 
+    def audio_formats(self):
+        '''audio formats `speaker` and `microphone` can use, see `audio_codec`'''
+        return list(audio_codec.FORMATS)
 
-    async def speaker(self, samplerate, dtype, blocksize, volume=None, *, request_stream):
+    async def speaker(self, samplerate, dtype, blocksize, volume=None, latency=.2, format='pcm', *, request_stream):
+        '''
+        play chunks of any size from `request_stream` through a ring buffer, `blocksize` is the number of frames per audio callback.
+        Playing starts once `latency` seconds of audio are buffered, and buffers that much again after the stream runs dry;
+        at most 4 times `latency` is kept, older audio is dropped beyond that.
+        Chunks in a compressed `format` (see `audio_formats`) are decoded to int16 off the event loop, `dtype` must be 'int16' then.
+        Returns `{'underruns': n, 'overruns': n, 'underrun_times': [t, ...]}`, the times (see `clock`) of the last 100 underruns
+        '''
         import sounddevice as sd
+        import numpy as np
+        from collections import deque
+        if format != 'pcm' and dtype != 'int16':
+            raise ValueError(f'dtype must be int16 for {format}')
+        codec = format != 'pcm' and audio_codec.Codec(format, samplerate)
         loop = asyncio.get_running_loop()
         done_ev = asyncio.Event()
+        underrun_times = deque(maxlen=100)
+        frame_size = np.dtype(dtype).itemsize
+        prebuffer = max(int(latency * samplerate), 1) * frame_size
+        ring = ByteRing(max(4 * prebuffer, 2 * blocksize * frame_size), prebuffer, frame_size)
 
         def fcb():
             self.mic_int = False
             self._speaker_power(None)
             loop.call_soon_threadsafe(done_ev.set)
 
-        zeros = None
-        def cb(outdata, frames, time, status): # don't do time consuming await/future.result() in this callback
-            nonlocal zeros
+        def cb(outdata, frames, stream_time, status): # don't do time consuming await/future.result() in this callback
             # if status:
             #     print('[speaker]', status)
                 # loop.call_soon_threadsafe(done_ev.set)
                 # raise sd.CallbackAbort
-            if request_stream.empty():
-                if not zeros:
-                    zeros = b'\x00' * len(outdata)
-                outdata[:] = zeros
-            else:
-                b = request_stream.get_nowait() # is get_nowait thread safe?
-                if isinstance(b, StopAsyncIteration):
-                    raise sd.CallbackStop
-                else:
-                    outdata[:] = b
-
-        while request_stream.empty():
-            await asyncio.sleep(.1)
-
-        self.mic_int = True
-        async with self.i2s_lock:
-            if volume is not None: # temporarily change volume
-                pre_vol = self.speaker_volume()
-                self.speaker_volume(volume)
-            self._speaker_power(1)
-            with sd.RawOutputStream(callback=cb, dtype=dtype, samplerate=samplerate, channels=1, blocksize=blocksize, finished_callback=fcb):
-                await done_ev.wait()
-                if volume is not None:
-                    self.speaker_volume(pre_vol)
+            underruns = ring.underruns
+            n = ring.read_into(outdata)
+            if ring.underruns != underruns:
+                underrun_times.append(time.monotonic())
+            if ring.ended and not ring.size and n < len(outdata):
+                raise sd.CallbackStop
+
+        async def feed():
+            # `request_stream` is any queue ending with an exception, e.g. `StopAsyncIteration()`,
+            # a `RPCStream` from the client or a plain `asyncio.Queue` from `util.beep` and `Sound.stream`
+            try:
+                while True:
+                    chunk = await request_stream.get()
+                    if isinstance(chunk, Exception):
+                        break
+                    ring.write(await loop.run_in_executor(None, codec.decode, chunk) if codec else chunk)
+            finally:
+                ring.end()
+
+        def feed_done(task):
+            if not task.cancelled() and task.exception():
+                print('[speaker]', repr(task.exception()))
+
+        feed_task = asyncio.create_task(feed())
+        feed_task.add_done_callback(feed_done)
+        try:
+            while not ring.primed:
+                await asyncio.sleep(.02)
 
+            self.mic_int = True
+            async with self.i2s_lock:
+                if volume is not None: # temporarily change volume
+                    pre_vol = self.speaker_volume()
+                    self.speaker_volume(volume)
+                self._speaker_power(1)
+                with sd.RawOutputStream(callback=cb, dtype=dtype, samplerate=samplerate, channels=1, blocksize=blocksize, finished_callback=fcb):
+                    await done_ev.wait()
+                    if volume is not None:
+                        self.speaker_volume(pre_vol)
+        finally:
+            feed_task.cancel()
+        return {'underruns': ring.underruns, 'overruns': ring.overruns, 'underrun_times': list(underrun_times)}
 
-    async def microphone(self, samplerate, dtype, blocksize):
+    async def microphone(self, samplerate, dtype, blocksize, timestamps=False, format='pcm'):
+        '''
+        yields blocks of `blocksize` frames, or `[t, block]` with `timestamps`,
+        `t` being when the first frame of the block was captured, see `clock`.
+        Blocks are encoded in `format` off the event loop (`dtype` must be 'int16' unless it's 'pcm'),
+        if `format` is a list of acceptable formats in order of preference, the first available one is used,
+        and its name is yielded before any block
+        '''
         import sounddevice as sd
+        fmt = audio_codec.negotiate(format)
+        if fmt != 'pcm' and dtype != 'int16':
+            raise ValueError(f'dtype must be int16 for {fmt}')
+        codec = fmt != 'pcm' and audio_codec.Codec(fmt, samplerate)
+        if not isinstance(format, str):
+            yield fmt
         loop = asyncio.get_running_loop()
         queue = RPCStream(2)
-        def cb(indata, frames, time, status):
+        def cb(indata, frames, stream_time, status):
             # if status:
             #     print('[mic]', status)
                 # raise sd.CallbackAbort
-            loop.call_soon_threadsafe(queue.force_put_nowait, bytes(indata))
+            # age of the first frame, by the stream's own clock if the driver reports it
+            age = stream_time.currentTime - stream_time.inputBufferAdcTime if stream_time.inputBufferAdcTime else frames / samplerate
+            loop.call_soon_threadsafe(queue.force_put_nowait, (time.monotonic() - age, bytes(indata)))
 
         while True:
             async with self.i2s_lock:
                 with sd.RawInputStream(callback=cb, samplerate=samplerate, blocksize=blocksize, channels=1, dtype=dtype):
                     while not self.mic_int:
-                        yield await queue.get()
+                        t, block = await queue.get()
+                        if codec:
+                            block = await loop.run_in_executor(None, codec.encode, block)
+                        yield [t, block] if timestamps else block
             await asyncio.sleep(.01)
 
@@ -1,62 +1,116 @@
 import RPi.GPIO as GPIO
 import time
 import threading
+import statistics
+from collections import deque
+
+SPEED_OF_SOUND = 343 # m/s
 
 class DistanceSensor:
-    def __init__(self, trigger, echo, max_distance, threshold_distance, inverval=.1, **kw):
+    '''
+    HC-SR04 sonar measured with GPIO edge callbacks instead of busy waiting:
+    the echo pulse is timed by the timestamps of its rising and falling edges, while the measuring thread sleeps.
+    A pulse whose edges don't come as rising then falling (noise, or a stale edge) is dropped and counted in `glitches`.
+
+    The timestamps are taken in Python when RPi.GPIO's event thread gets the GIL, not by the kernel, so with the display,
+    camera and input threads busy they're off by up to a millisecond or so, i.e. several centimeters.
+    The median filter takes care of the occasional outlier, finer readings would need a backend with kernel timestamps like pigpio.
+
+    Readings are filtered with the median (or an EMA with `alpha` if `filter` is 'ema') of the last `queue_len` ones.
+    Measuring goes at `fast_interval` when something is within twice `threshold_distance` or `moving()` returns True,
+    and slows down to `idle_interval` after `idle_after` seconds of neither, otherwise it's every `inverval` seconds.
+    A pulse that doesn't end within the time sound takes to travel `max_distance` and back reads as `max_distance`
+    '''
+    def __init__(self, trigger, echo, max_distance, threshold_distance, inverval=.1, *, queue_len=5, filter='median', alpha=.5,
+                 fast_interval=.05, idle_interval=.5, idle_after=2, **kw):
+        if filter not in ('median', 'ema', None):
+            raise ValueError("filter must be 'median', 'ema' or None")
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(trigger, GPIO.OUT)
+        GPIO.setup(trigger, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(echo, GPIO.IN)
         self.trigger = trigger
         self.echo = echo
         self.max_distance = max_distance
         self.threshold_distance = threshold_distance
         self.inverval = inverval
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.filter = filter
+        self.alpha = alpha
+        self.moving = lambda: False
+        self._samples = deque(maxlen=queue_len)
         self._distance = max_distance
+        self.timestamp = None # time.monotonic() of the last reading
+        self.timeouts = self.readings = self.glitches = 0
+        self._edges = []
+        self._echoed = threading.Event()
+        self._last_active = time.monotonic()
         self.when_in_range = self.when_out_of_range = None
+        self.when_measured = None # called with every distance measured
+        GPIO.add_event_detect(echo, GPIO.BOTH, callback=self._on_edge)
+        self._stop = threading.Event()
         self.th = threading.Thread(target=self.run, daemon=True)
-        self._run = True
         self.th.start()
 
     def __del__(self):
         self.close()
 
     def close(self):
-        self._run = False
-        self.th.join(10)
+        if not self._stop.is_set():
+            self._stop.set()
+            self.th.join(10)
+            GPIO.remove_event_detect(self.echo)
+
+    def _on_edge(self, channel):
+        # runs in the RPi.GPIO event thread, the first edge after a trigger is the start of the echo, the second its end
+        self._edges.append((time.monotonic(), GPIO.input(channel)))
+        len(self._edges) == 2 and self._echoed.set()
+
+    @property
+    def interval(self):
+        now = time.monotonic()
+        if self._distance < 2 * self.threshold_distance or self.moving():
+            self._last_active = now
+            return self.fast_interval
+        return self.inverval if now - self._last_active < self.idle_after else self.idle_interval
 
     def run(self):
-        while self._run:
-            time.sleep(self.inverval)
+        while not self._stop.wait(self.interval):
             self.get_distance()
 
     def get_distance(self):
-        # set Trigger to HIGH
+        if GPIO.input(self.echo): # still echoing from the last trigger
+            return
+        self._edges = []
+        self._echoed.clear()
         GPIO.output(self.trigger, True)
-
-        # set Trigger after 0.01ms to LOW
         time.sleep(0.00001)
         GPIO.output(self.trigger, False)
-
-        StartTime = StopTime = TriggerTime = time.time()
-
-        # save StartTime
-        while GPIO.input(self.echo) == 0:
-            StartTime = time.time()
-            if StartTime - TriggerTime > 0.001:
+        # the sensor sends its burst for about .5ms before the echo pulse starts
+        if self._echoed.wait(.002 + 2 * self.max_distance / SPEED_OF_SOUND):
+            (start, high), (stop, low) = self._edges[:2]
+            if not (high and not low):
+                self.glitches += 1
                 return
+            distance = min((stop - start) * SPEED_OF_SOUND / 2, self.max_distance)
+        else:
+            self.timeouts += 1
+            distance = self.max_distance
+        self.readings += 1
+        self._update(distance)
 
-        # save time of arrival
-        while GPIO.input(self.echo) == 1:
-            pass
-        StopTime = time.time()
+    def _update(self, distance):
+        self._samples.append(distance)
+        if self.filter == 'median':
+            distance = statistics.median(self._samples)
+        elif self.filter == 'ema' and self.timestamp is not None:
+            distance = self._distance + self.alpha * (distance - self._distance)
+        self.timestamp = time.monotonic()
 
-        # time difference between start and arrival
-        TimeElapsed = StopTime - StartTime
-        # multiply with the sonic speed (34300 cm/s)
-        # and divide by 2, because there and back
         self._last_distance = self._distance
-        self._distance = min((TimeElapsed * 343) / 2, self.max_distance)
+        self._distance = distance
+        self.when_measured and self.when_measured(self._distance)
 
         if self._distance > self.threshold_distance > self._last_distance:
             self.when_out_of_range and self.when_out_of_range()
@@ -66,4 +120,3 @@ class DistanceSensor:
     @property
     def distance(self):
         return self._distance
-
@@ -0,0 +1,114 @@
+import asyncio, functools
+import numpy as np
+from PIL import ImageColor
+
+# the face is drawn in landscape (240x135) and rotated to the screen's portrait orientation
+WIDTH, HEIGHT = 240, 135
+EYE_WIDTH, EYE_HEIGHT, EYE_RADIUS = 54, 66, 14
+EYE_SPACING = 50 # from the center of the screen to the center of an eye
+GAZE_X, GAZE_Y = 40, 25 # max offset of the eyes when looking aside/up/down
+BLINK_DURATION = .16
+
+@functools.lru_cache(maxsize=128)
+def rounded_rect(w, h, r):
+    '''boolean mask of a `w`x`h` rectangle with corners of radius `r`'''
+    r = min(r, w//2, h//2)
+    y, x = np.ogrid[:h, :w]
+    cx, cy = np.clip(x, r, w-1-r), np.clip(y, r, h-1-r)
+    mask = (x-cx)**2 + (y-cy)**2 <= r*r
+    mask.flags.writeable = False
+    return mask
+
+def to_color565(color):
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    if isinstance(color, (list, tuple)):
+        r, g, b = color[:3]
+        return (r & 0xF8) << 8 | (g & 0xFC) << 3 | b >> 3
+    return color
+
+class Face:
+    '''parameters of the eyes, interpolated toward their targets at every `step`'''
+    def __init__(self, color='cyan'):
+        self.params = {'open': 1., 'gaze_x': 0., 'gaze_y': 0., 'squint': 0.}
+        self.target = dict(self.params)
+        self.velocity = dict.fromkeys(self.params, 0.)
+        self.color = to_color565(color)
+        self.blink_interval = None
+        self._blink_t = None # time since the current blink started
+        self._since_blink = 0
+        self.dirty = True
+
+    def set(self, transition=.2, **target):
+        for k, v in target.items():
+            if k not in self.params:
+                raise ValueError(f'Unknown eye parameter {k}')
+            self.target[k] = v
+            if transition:
+                self.velocity[k] = abs(v - self.params[k]) / transition
+            else:
+                # jump right there, an infinite velocity would make `step(0)` NaN
+                self.params[k], self.velocity[k] = v, 0.
+                self.dirty = True
+
+    def set_color(self, color):
+        self.color = to_color565(color)
+        self.dirty = True
+
+    def blink(self):
+        self._blink_t = 0
+
+    def step(self, dt):
+        '''advance `dt` seconds, returns True if the face has changed'''
+        changed, self.dirty = self.dirty, False
+        for k, v in self.target.items():
+            cur = self.params[k]
+            if cur != v:
+                inc = self.velocity[k] * dt
+                self.params[k] = v if abs(v - cur) <= inc else cur + (inc if v > cur else -inc)
+                changed = True
+        self._since_blink += dt
+        if self.blink_interval and self._blink_t is None and self._since_blink >= self.blink_interval:
+            self.blink()
+        if self._blink_t is not None:
+            self._blink_t += dt
+            if self._blink_t >= BLINK_DURATION:
+                self._blink_t = None
+                self._since_blink = 0
+            changed = True
+        return changed
+
+    def lid(self):
+        # 1 is open, goes down to 0 and back up during a blink
+        return 1 if self._blink_t is None else abs(1 - 2 * self._blink_t / BLINK_DURATION)
+
+    def render(self):
+        '''the face as a RGB565 array in screen orientation'''
+        img = np.zeros((HEIGHT, WIDTH), dtype='>u2')
+        p = self.params
+        h = max(2, int(round(EYE_HEIGHT * p['open'] * self.lid())))
+        mask = rounded_rect(EYE_WIDTH, h, EYE_RADIUS)
+        mask = mask[:max(2, h - int(p['squint'] * h * .5))] # squint raises the lower lid
+        top = int(round(HEIGHT/2 + p['gaze_y'] * GAZE_Y - h/2))
+        for side in (-1, 1):
+            left = int(round(WIDTH/2 + side * EYE_SPACING + p['gaze_x'] * GAZE_X - EYE_WIDTH/2))
+            x0, y0 = max(0, left), max(0, top)
+            x1, y1 = min(WIDTH, left + mask.shape[1]), min(HEIGHT, top + mask.shape[0])
+            if x0 < x1 and y0 < y1:
+                img[y0:y1, x0:x1][mask[y0-top:y1-top, x0-left:x1-left]] = self.color
+        return np.rot90(img)
+
+async def run(face, display_worker, fps=30):
+    '''render `face` at `fps`, drawing only when it has changed'''
+    clock = asyncio.get_running_loop().time
+    interval = 1 / fps
+    last = next_t = clock()
+    while True:
+        now = clock()
+        if face.step(now - last):
+            display_worker.draw(face.render(), 0, 0)
+        last = now
+        next_t += interval
+        if next_t < now:
+            next_t = now
+        await asyncio.sleep(next_t - now)
@@ -0,0 +1,250 @@
+import numpy as np
+import threading
+
+def dirty_rects(changed, gap=8, overhead=64):
+    '''
+    cover the True pixels of the 2d mask `changed` with a few rectangles (x, y, x1, y1).
+    Changed rows are grouped into bands separated by more than `gap` unchanged rows,
+    then neighbouring bands are merged if the extra pixels cost less than `overhead` bytes
+    '''
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not rows.size:
+        return []
+    rects = []
+    for band in np.split(rows, np.flatnonzero(np.diff(rows) > gap) + 1):
+        r0, r1 = int(band[0]), int(band[-1])
+        cols = np.flatnonzero(changed[r0:r1+1].any(axis=0))
+        rects.append([int(cols[0]), r0, int(cols[-1]), r1])
+    area = lambda r: (r[2]-r[0]+1) * (r[3]-r[1]+1) * 2
+    merged = [rects[0]]
+    for r in rects[1:]:
+        last = merged[-1]
+        union = [min(last[0], r[0]), last[1], max(last[2], r[2]), r[3]]
+        if area(union) <= area(last) + area(r) + overhead:
+            merged[-1] = union
+        else:
+            merged.append(r)
+    return merged
+
+class FrameBuffer:
+    '''
+    Shadow copy of the screen RAM in big-endian RGB565.
+
+    Every update is diffed against the shadow copy, and only the changed rectangles are sent to the screen,
+    so that a frame in which only the eyes move costs a few hundred bytes of SPI traffic instead of 64KB.
+    Coordinates are those of the screen driver (135x240, portrait)
+    '''
+    def __init__(self, screen, width, height, gap=8, overhead=64):
+        self.screen = screen
+        self.width = width
+        self.height = height
+        # unchanged rows allowed inside one rectangle before it is split in two
+        self.gap = gap
+        # estimated cost (in bytes) of opening a new window on the screen,
+        # two rectangles are merged when the extra pixels cost less than this
+        self.overhead = overhead
+        self.buf = np.zeros((height, width), dtype='>u2')
+        self.known = np.zeros((height, width), dtype=bool)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.bytes_sent = self.bytes_saved = self.windows = 0
+
+    def stats(self):
+        return {'bytes_sent': self.bytes_sent, 'bytes_saved': self.bytes_saved, 'windows': self.windows}
+
+    def invalidate(self):
+        # call this after drawing on the screen without going through the frame buffer
+        self.known[:] = False
+
+    def _check_region(self, x, y, x1, y1):
+        if not (0 <= x <= x1 < self.width and 0 <= y <= y1 < self.height):
+            raise ValueError(f'Region ({x}, {y}, {x1}, {y1}) out of screen {self.width}x{self.height}')
+
+    @staticmethod
+    def to_pixels(data, w, h):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(data, dtype=np.uint8)
+        else:
+            data = np.asarray(data, dtype=np.uint8)
+        if data.size != w * h * 2:
+            raise ValueError(f'Expect {w*h*2} bytes of RGB565 data for a {w}x{h} block, got {data.size}')
+        return data.view('>u2').reshape(h, w)
+
+    def changed_rects(self, new, x, y):
+        '''rectangles (x, y, x1, y1) in which `new` differs from the shadow copy, relative to `new`'''
+        h, w = new.shape
+        changed = self.buf[y:y+h, x:x+w] != new
+        changed |= ~self.known[y:y+h, x:x+w]
+        return dirty_rects(changed, self.gap, self.overhead)
+
+    def update(self, new, x, y):
+        '''write the 2d RGB565 array `new` at (x, y), sending only what has changed'''
+        h, w = new.shape
+        self._check_region(x, y, x+w-1, y+h-1)
+        sent = 0
+        for cx, cy, cx1, cy1 in self.changed_rects(new, x, y):
+            block = new[cy:cy1+1, cx:cx1+1]
+            self.screen._block(x+cx, y+cy, x+cx1, y+cy1, block.tobytes())
+            sent += block.nbytes
+            self.windows += 1
+        self.buf[y:y+h, x:x+w] = new
+        self.known[y:y+h, x:x+w] = True
+        self.bytes_sent += sent
+        self.bytes_saved += new.nbytes - sent
+
+    def display(self, data, x, y, x1, y1):
+        self._check_region(x, y, x1, y1)
+        self.update(FrameBuffer.to_pixels(data, x1-x+1, y1-y+1), x, y)
+
+    def clip(self, x, y, w, h):
+        # clip like `screen.fill_rectangle` does
+        x = min(self.width - 1, max(0, x))
+        y = min(self.height - 1, max(0, y))
+        return x, y, min(self.width - x, max(1, w)), min(self.height - y, max(1, h))
+
+    def fill(self, color565, x, y, w, h):
+        x, y, w, h = self.clip(x, y, w, h)
+        self.update(np.full((h, w), color565, dtype='>u2'), x, y)
+
+    def pixel(self, x, y, color565=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        if color565 is None:
+            return int(self.buf[y, x]) if self.known[y, x] else self.screen.pixel(x, y)
+        self.update(np.full((1, 1), color565, dtype='>u2'), x, y)
+
+
+def blend(frame, over, alpha):
+    '''lay the RGB565 pixels `over` on `frame` in place, `alpha` 0~255 being how opaque each pixel of `over` is'''
+    opaque = alpha == 255
+    frame[opaque] = over[opaque]
+    edge = (alpha > 0) & ~opaque
+    if edge.any():
+        a = alpha[edge].astype(np.uint32)
+        f, o = frame[edge].astype(np.uint32), over[edge].astype(np.uint32)
+        out = np.zeros_like(f)
+        for shift, bits in ((11, 0x1F), (5, 0x3F), (0, 0x1F)):
+            out |= ((o >> shift & bits) * a + (f >> shift & bits) * (255 - a)) // 255 << shift
+        frame[edge] = out
+
+class DisplayWorker(threading.Thread):
+    '''
+    Pushes frames to the screen from a background thread, so the SPI transfer doesn't block the event loop.
+
+    The RPCs draw into the back buffer and return immediately, the worker thread copies the changed region
+    out of it and hands it to the `FrameBuffer` (the front buffer, i.e. what's on the screen).
+    If several frames are drawn while the worker is busy, only the latest one is presented.
+    An overlay (see `overlay`) is laid over the back buffer as it's presented, so it stays on top of whatever is drawn under it
+    '''
+    def __init__(self, framebuffer, loop):
+        threading.Thread.__init__(self, daemon=True)
+        self.framebuffer = framebuffer
+        self.loop = loop
+        self.back = framebuffer.buf.copy()
+        self.over = np.zeros_like(self.back)
+        self.alpha = np.zeros(self.back.shape, dtype=np.uint8)
+        self._has_overlay = False
+        self._cond = threading.Condition()
+        self._dirty = None # bounding box (x, y, x1, y1) of what's drawn since last present
+        self._running = True
+        self.queued = self.presented = 0 # sequence number of the last queued/presented frame
+        self.draws = self.presents = 0
+        self._vsync_waiters = []
+        self.start()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self.join(10)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._dirty is None and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                x, y, x1, y1 = self._dirty
+                self._dirty = None
+                frame = self.back[y:y1+1, x:x1+1].copy()
+                over = self._has_overlay and (self.over[y:y1+1, x:x1+1].copy(), self.alpha[y:y1+1, x:x1+1].copy())
+                seq = self.queued
+            over and blend(frame, *over)
+            try:
+                self.framebuffer.update(frame, x, y)
+            except Exception as e:
+                print(e)
+            self.presents += 1
+            self.loop.call_soon_threadsafe(self._on_present, seq)
+
+    def _on_present(self, seq):
+        self.presented = seq
+        waiters, self._vsync_waiters = self._vsync_waiters, []
+        for target, fut in waiters:
+            if target > seq:
+                self._vsync_waiters.append((target, fut))
+            elif not fut.done():
+                fut.set_result(seq)
+
+    async def vsync(self):
+        '''wait until everything drawn so far is on the screen'''
+        if self.presented >= self.queued:
+            return self.presented
+        fut = self.loop.create_future()
+        self._vsync_waiters.append((self.queued, fut))
+        return await fut
+
+    def stats(self):
+        return dict(self.framebuffer.stats(), frames_queued=self.draws, frames_presented=self.presents, frames_superseded=self.draws-self.presents)
+
+    def reset_stats(self):
+        self.framebuffer.reset_stats()
+        self.draws = self.presents = 0
+
+    def draw(self, pixels, x, y):
+        h, w = pixels.shape
+        self.framebuffer._check_region(x, y, x+w-1, y+h-1)
+        with self._cond:
+            self.back[y:y+h, x:x+w] = pixels
+            self._queue(x, y, w, h)
+
+    def overlay(self, pixels, alpha, x, y):
+        '''set a region of the overlay to the RGB565 `pixels` with opacity `alpha` (0~255 arrays of the same shape)'''
+        h, w = pixels.shape
+        self.framebuffer._check_region(x, y, x+w-1, y+h-1)
+        with self._cond:
+            self.over[y:y+h, x:x+w] = pixels
+            self.alpha[y:y+h, x:x+w] = alpha
+            self._has_overlay = bool(self.alpha.any())
+            self._queue(x, y, w, h)
+
+    def _queue(self, x, y, w, h):
+        # with `_cond` held
+        d = self._dirty
+        self._dirty = (x, y, x+w-1, y+h-1) if d is None else (min(d[0], x), min(d[1], y), max(d[2], x+w-1), max(d[3], y+h-1))
+        self.queued += 1
+        self.draws += 1
+        self._cond.notify()
+
+    def clear(self, color565=0):
+        # the screen content is unknown at this point, so the whole screen is sent once
+        with self._cond:
+            self.framebuffer.invalidate()
+        self.draw(np.full(self.back.shape, color565, dtype='>u2'), 0, 0)
+
+    def display(self, data, x, y, x1, y1):
+        self.framebuffer._check_region(x, y, x1, y1)
+        self.draw(FrameBuffer.to_pixels(data, x1-x+1, y1-y+1), x, y)
+
+    def fill(self, color565, x, y, w, h):
+        x, y, w, h = self.framebuffer.clip(x, y, w, h)
+        self.draw(np.full((h, w), color565, dtype='>u2'), x, y)
+
+    def pixel(self, x, y, color565=None):
+        if not (0 <= x < self.framebuffer.width and 0 <= y < self.framebuffer.height):
+            return None
+        if color565 is None:
+            return int(self.back[y, x])
+        self.draw(np.full((1, 1), color565, dtype='>u2'), x, y)
@@ -0,0 +1,76 @@
+'''
+Decode compressed frames into big-endian RGB565 arrays for the frame buffer.
+
+Supported formats:
+
+* ``'jpeg'``, ``'png'`` (or ``'image'``, anything PIL can open)
+* ``'rle'``: runs of 3 bytes, a uint8 run length followed by a big-endian RGB565 color
+* ``'palette'``: indices into a palette of RGB565 colors, packed 1, 2, 4 or 8 bits per pixel, most significant bits first, no row padding
+'''
+import io
+import numpy as np
+from PIL import Image
+
+FORMATS = ('jpeg', 'png', 'image', 'rle', 'palette')
+
+def rgb565(image):
+    '''convert a PIL image or a HxWx3 RGB uint8 array to a HxW big-endian RGB565 array'''
+    if isinstance(image, Image.Image):
+        image = np.asarray(image.convert('RGB'))
+    rgb = image.astype(np.uint16)
+    return (((rgb[..., 0] & 0xF8) << 8) | ((rgb[..., 1] & 0xFC) << 3) | (rgb[..., 2] >> 3)).astype('>u2')
+
+def rgb(pixels):
+    '''convert a HxW RGB565 array back to a HxWx3 RGB uint8 array'''
+    p = pixels.astype(np.uint16)
+    r, g, b = (p >> 11) & 0x1F, (p >> 5) & 0x3F, p & 0x1F
+    return np.dstack(((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2))).astype(np.uint8)
+
+def fit(pixels, w, h):
+    # a landscape frame for a portrait window is rotated the same way `Screen.display` in cozmars.js does
+    if pixels.shape == (h, w):
+        return pixels
+    if pixels.shape == (w, h):
+        return np.ascontiguousarray(np.rot90(pixels))
+    raise ValueError(f'Frame size {pixels.shape[1]}x{pixels.shape[0]} does not fit a {w}x{h} block')
+
+def decode_image(data, w, h):
+    with Image.open(io.BytesIO(data)) as img:
+        return fit(rgb565(img), w, h)
+
+def decode_rle(data, w, h):
+    runs = np.frombuffer(data, dtype=[('n', 'u1'), ('c', '>u2')])
+    pixels = np.repeat(runs['c'], runs['n'])
+    if pixels.size != w * h:
+        raise ValueError(f'RLE data has {pixels.size} pixels, expect {w*h}')
+    return pixels.reshape(h, w)
+
+def decode_palette(data, w, h, palette, bits=8):
+    if bits not in (1, 2, 4, 8):
+        raise ValueError('bits must be 1, 2, 4 or 8')
+    palette = np.asarray(palette, dtype='>u2')
+    if len(palette) > 1 << bits:
+        raise ValueError(f'Palette of {len(palette)} colors can not be indexed with {bits} bits')
+    packed = np.frombuffer(data, dtype=np.uint8)
+    if bits == 8:
+        idx = packed
+    else:
+        shifts = np.arange(8-bits, -1, -bits, dtype=np.uint8)
+        idx = ((packed[:, None] >> shifts) & ((1 << bits) - 1)).ravel()
+    if idx.size < w * h:
+        raise ValueError(f'Palette data has {idx.size} pixels, expect {w*h}')
+    return palette[idx[:w*h]].reshape(h, w)
+
+def decode(data, format, w, h, palette=None, bits=8):
+    '''decode `data` of `format` into a `h`x`w` RGB565 array'''
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+    if format in ('jpeg', 'png', 'image'):
+        return decode_image(data, w, h)
+    elif format == 'rle':
+        return decode_rle(data, w, h)
+    elif format == 'palette':
+        if palette is None:
+            raise ValueError('palette is required for palette format')
+        return decode_palette(data, w, h, palette, bits)
+    raise ValueError(f'Unknown format {format}, must be one of {FORMATS}')
@@ -0,0 +1,166 @@
+import RPi.GPIO as GPIO
+import time
+import threading
+
+class Input:
+    '''a debounced digital input sampled by `InputHub`, active when the pin is low if `pull_up`'''
+    def __init__(self, hub, pin, pull_up=True, debounce=.02):
+        self.hub = hub
+        self.pin = pin
+        self.active_state = not pull_up
+        self.debounce = debounce
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP if pull_up else GPIO.PUD_DOWN)
+        self._state = self._raw = GPIO.input(pin) == self.active_state
+        self._raw_since = self.timestamp = time.monotonic() # `timestamp` is when the debounced state last changed
+        try:
+            # edges wake the hub right away rather than at its next tick
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=hub.wake)
+        except RuntimeError as e:
+            print(e)
+
+    @property
+    def value(self):
+        return int(self._state)
+
+    @property
+    def is_active(self):
+        return self._state
+
+    def close(self):
+        self.hub.remove(self)
+        GPIO.remove_event_detect(self.pin)
+
+    def _sample(self, raw, now):
+        '''returns whether the debounced state has changed'''
+        if raw != self._raw:
+            self._raw, self._raw_since = raw, now
+        if raw != self._state and now - self._raw_since >= self.debounce:
+            self._state = raw
+            self.timestamp = self._raw_since
+            return True
+        return False
+
+    def _callbacks(self, changed, now):
+        return []
+
+class LineSensor(Input):
+    '''
+    replaces `gpiozero.LineSensor` with the same polarity: `value` is 1 when the sensor is active (it sees the light reflected by the surface),
+    and 0 when it sees a (dark) line or nothing at all, that's when `line_detected` is True
+    '''
+    def __init__(self, hub, pin, **kw):
+        super().__init__(hub, pin, **kw)
+        self.when_line = self.when_no_line = None
+
+    @property
+    def line_detected(self):
+        return not self._state
+
+    def _callbacks(self, changed, now):
+        return [self.when_no_line if self._state else self.when_line] if changed else []
+
+class Button(Input):
+    '''replaces `gpiozero.Button`, with `when_pressed`, `when_released`, `when_held`, `hold_time` and `hold_repeat`'''
+    def __init__(self, hub, pin, hold_time=1, hold_repeat=False, **kw):
+        super().__init__(hub, pin, **kw)
+        self.hold_time = hold_time
+        self.hold_repeat = hold_repeat
+        self.when_pressed = self.when_released = self.when_held = None
+        self._pressed_at = self._held_at = None
+        self.presses = 0
+
+    @property
+    def is_pressed(self):
+        return self._state
+
+    @property
+    def is_held(self):
+        return self._held_at is not None
+
+    def _callbacks(self, changed, now):
+        if changed:
+            if self._state:
+                self._pressed_at = now
+                self.presses += 1
+                return [self.when_pressed]
+            self._pressed_at = self._held_at = None
+            return [self.when_released]
+        if self._pressed_at is not None:
+            due = self._pressed_at + self.hold_time if self._held_at is None else self._held_at + self.hold_time if self.hold_repeat else None
+            if due is not None and now >= due:
+                self._held_at = now
+                return [self.when_held]
+        return []
+
+class InputHub(threading.Thread):
+    '''
+    Samples all the digital inputs from one thread at `rate` Hz, instead of a thread per gpiozero device.
+    An edge on any input wakes the thread at once, and it samples again as soon as a change has lasted the input's debounce time.
+
+    `when_changed(inputs)` is called in this thread with the inputs whose debounced state has changed,
+    for reactions that can't wait for the event loop. The callbacks of the inputs (`when_pressed`, `when_line`, ...)
+    are run in `loop`, all of those of a tick with a single `call_soon_threadsafe`
+    '''
+    def __init__(self, loop, rate=50):
+        super().__init__(daemon=True)
+        GPIO.setmode(GPIO.BCM)
+        self.loop = loop
+        self.rate = rate
+        self.inputs = []
+        self.when_changed = None
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+        self.start()
+
+    def line_sensor(self, pin, **kw):
+        return self.add(LineSensor(self, pin, **kw))
+
+    def button(self, pin, **kw):
+        return self.add(Button(self, pin, **kw))
+
+    def add(self, input):
+        self.inputs = self.inputs + [input] # replaced rather than changed in place, it's iterated in the thread
+        return input
+
+    def remove(self, input):
+        self.inputs = [i for i in self.inputs if i is not input]
+
+    def wake(self, pin=None):
+        self._wake.set()
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        self.join(1)
+
+    def run(self):
+        timeout = 1 / self.rate
+        while True:
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._closed.is_set():
+                break
+            now = time.monotonic()
+            changed, callbacks = [], []
+            for input in self.inputs:
+                c = input._sample(GPIO.input(input.pin) == input.active_state, now)
+                c and changed.append(input)
+                callbacks += input._callbacks(c, now)
+            if changed and self.when_changed:
+                try:
+                    self.when_changed(changed)
+                except Exception as e:
+                    print(e)
+            callbacks = [cb for cb in callbacks if cb]
+            callbacks and self.loop.call_soon_threadsafe(self._dispatch, callbacks)
+            # changes still bouncing are sampled again right when their debounce time is up
+            pending = [i._raw_since + i.debounce - now for i in self.inputs if i._raw != i._state]
+            timeout = max(.001, min(pending + [1 / self.rate]))
+
+    @staticmethod
+    def _dispatch(callbacks):
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception as e:
+                print(e)
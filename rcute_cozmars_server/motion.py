@@ -0,0 +1,159 @@
+import asyncio
+import contextlib
+from collections import deque
+
+EASINGS = {
+    'linear': lambda t: t,
+    'ease_in': lambda t: t * t,
+    'ease_out': lambda t: t * (2 - t),
+    'ease_in_out': lambda t: t * t * (3 - 2 * t),
+    'min_jerk': lambda t: t * t * t * (10 - 15 * t + 6 * t * t),
+}
+
+def lerp(a, b, k):
+    if isinstance(a, tuple):
+        return tuple(x + (y - x) * k for x, y in zip(a, b))
+    return a + (b - a) * k
+
+class Move:
+    def __init__(self, target, duration, easing, future):
+        if easing not in EASINGS:
+            raise ValueError(f'Unknown easing {easing}, must be one of {list(EASINGS)}')
+        self.target = target
+        self.duration = duration
+        self.ease = EASINGS[easing]
+        self.future = future
+        self.start = self.t0 = None
+
+    def begin(self, start, t0):
+        self.start, self.t0 = start, t0
+
+    def at(self, t):
+        '''value at time `t`, and whether the move is done'''
+        k = (t - self.t0) / self.duration if self.duration else 1
+        if k >= 1:
+            return self.target, True
+        return lerp(self.start, self.target, self.ease(k)), False
+
+    def finish(self, result):
+        self.future.done() or self.future.set_result(result)
+
+    def fail(self, exc):
+        self.future.done() or self.future.set_exception(exc)
+
+class Actuator:
+    def __init__(self, read, write, limit=None):
+        self.read = read
+        self.write = write
+        self.limit = limit or (lambda value: value) # applied to every value before it's written
+        self.move = None
+        self.queue = deque()
+        self.seq = 0 # incremented by every command, to tell if a command has been overridden
+        self.last = None
+
+class MotionScheduler:
+    '''
+    A single control loop ticking at `rate` Hz that owns the targets of all actuators.
+
+    Each tick, every actuator with a move in progress gets its eased value, then all changed values are written
+    in one pass inside `batch()` if given, e.g. `ServoKit.batch` sends them in as few I2C transactions as possible. A new move on an actuator preempts the one in progress,
+    or waits behind it if `queue` is True. The loop only runs while there are moves in progress
+    '''
+    def __init__(self, rate, batch=None):
+        self.rate = rate
+        self.batch = batch or contextlib.nullcontext
+        self.actuators = {}
+        self._task = None
+
+    def add(self, name, read, write, limit=None):
+        '''`limit(value)` returns the value that's actually written, e.g. to cap the speed when there's an obstacle ahead'''
+        self.actuators[name] = Actuator(read, write, limit)
+
+    def seq(self, name):
+        return self.actuators[name].seq
+
+    def move(self, name, target, duration, easing='linear', queue=False):
+        '''returns a future, which is True when the move completes, or False if it's preempted or stopped'''
+        act = self.actuators[name]
+        loop = asyncio.get_running_loop()
+        m = Move(target, duration, easing, loop.create_future())
+        act.seq += 1
+        if queue and act.move:
+            act.queue.append(m)
+        else:
+            self._cancel(act)
+            m.begin(act.read(), loop.time())
+            act.move = m
+            act.last = None # the actuator may have been changed behind the scheduler's back, e.g. relaxed
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return m.future
+
+    def _fail(self, act, move, exc):
+        # a write failed: drop the moves of `act`, the awaiting command raises `exc` instead of hanging
+        print('[motion]', repr(exc))
+        move.fail(exc)
+        act.move and act.move.fail(exc)
+        self._cancel(act)
+        act.last = None
+
+    def _cancel(self, act):
+        for m in [act.move, *act.queue]:
+            m and m.finish(False)
+        act.move = None
+        act.queue.clear()
+
+    def stop(self, name=None):
+        '''stop the moves of actuator `name`, or of all actuators, where they are'''
+        for n in [name] if name else self.actuators:
+            act = self.actuators[n]
+            act.seq += 1
+            self._cancel(act)
+
+    def set(self, name, value):
+        '''stop moving actuator `name` and set it to `value` at once'''
+        self.stop(name)
+        act = self.actuators[name]
+        value = act.limit(value)
+        act.write(value)
+        act.last = value
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.rate
+        next_t = loop.time()
+        while any(a.move for a in self.actuators.values()):
+            next_t += interval
+            await asyncio.sleep(next_t - loop.time())
+            now = loop.time()
+            writes = []
+            for act in self.actuators.values():
+                if not act.move:
+                    continue
+                move = act.move
+                value, done = move.at(now)
+                try:
+                    limited = act.limit(value)
+                except Exception as e:
+                    self._fail(act, move, e)
+                    continue
+                if limited != act.last:
+                    writes.append((act, limited, move))
+                if done:
+                    act.move.finish(True)
+                    act.move = act.queue.popleft() if act.queue else None
+                    act.move and act.move.begin(value, now)
+            if writes:
+                try:
+                    with self.batch():
+                        for act, value, move in writes:
+                            try:
+                                act.write(value)
+                                act.last = value
+                            except Exception as e:
+                                self._fail(act, move, e)
+                except Exception as e: # e.g. the batched I2C transfer failed
+                    for act, value, move in writes:
+                        self._fail(act, move, e)
+            if next_t < now:
+                next_t = now
@@ -1,6 +1,10 @@
+import struct
+import contextlib
 import board
 from adafruit_pca9685 import PCA9685
 
+_LED0_ON_L = 0x06 # first PWM register, each channel has 4: ON_L, ON_H, OFF_L, OFF_H
+
 class ServoKit:
     def __init__(self, *, channels, freq, i2c=None, address=0x40, reference_clock_speed=25000000):
         if channels not in [8, 16]:
@@ -12,8 +16,58 @@ class ServoKit:
         self._pca = PCA9685(
             i2c, address=address, reference_clock_speed=reference_clock_speed
         )
-        self._pca.frequency = freq
+        self._pca.frequency = freq # this also turns on register auto-increment (MODE1 AI bit)
         self._servo = _Servo(self)
+        # shadow copy of the 16-bit duty cycle of each channel, so it's never read back from the chip,
+        # None until the channel is first written
+        self._duty = [None] * 16
+        self._dirty = set()
+        self._batching = 0
+
+    def set_duty(self, channel, duty):
+        '''set the 16-bit duty cycle of `channel`, nothing is sent if it's unchanged'''
+        if self._duty[channel] == duty:
+            return
+        self._duty[channel] = duty
+        if self._batching:
+            self._dirty.add(channel)
+        else:
+            self._write(channel, [duty])
+
+    def get_duty(self, channel):
+        return self._duty[channel] or 0
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''defer duty cycle writes until the outermost batch exits, then send them with `commit()`'''
+        self._batching += 1
+        try:
+            yield self
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self.commit()
+
+    def commit(self):
+        '''write pending channels, each run of contiguous channels in one I2C transaction'''
+        if not self._dirty:
+            return
+        channels = sorted(self._dirty)
+        self._dirty.clear()
+        start = prev = channels[0]
+        for ch in channels[1:] + [None]:
+            if ch != prev + 1:
+                self._write(start, self._duty[start:prev+1])
+                start = ch
+            prev = ch
+
+    def _write(self, channel, duties):
+        # same conversion from 16-bit duty cycle to 12-bit ON/OFF counts as `PWMChannel.duty_cycle` of adafruit_pca9685
+        buf = bytearray([_LED0_ON_L + 4 * channel])
+        for d in duties:
+            buf += struct.pack('<HH', 0x1000, 0) if d == 0xFFFF else struct.pack('<HH', 0, (d + 1) >> 4)
+        with self._pca.i2c_device as i2c:
+            i2c.write(buf)
 
     @property
     def servo(self):
@@ -31,7 +85,7 @@ class _Servo:
             raise ValueError("servo must be 0-{}!".format(num_channels - 1))
         servo = self.kit._items[servo_channel]
         if servo is None:
-            servo = Servo(self.kit._pca.channels[servo_channel])
+            servo = Servo(self.kit, self.kit._pca.channels[servo_channel])
             self.kit._items[servo_channel] = servo
             return servo
         if isinstance(self.kit._items[servo_channel], Servo):
@@ -42,7 +96,8 @@ class _Servo:
         return len(self.kit._items)
 
 class Servo:
-    def __init__(self, pwm_out, *, start_angle=0, end_angle=180, min_pulse=750, max_pulse=2250):
+    def __init__(self, kit, pwm_out, *, start_angle=0, end_angle=180, min_pulse=750, max_pulse=2250):
+        self._kit = kit
         self._pwm_out = pwm_out
         self._last_fraction = None
         self.set_pulse_width_range(min_pulse, max_pulse)
@@ -79,20 +134,21 @@ class Servo:
         For conventional servos, corresponds to the servo position as a fraction
         of the actuation range. Is None when servo is diabled (pulsewidth of 0ms).
         """
-        if self._pwm_out.duty_cycle == 0 and self._min_duty != 0:  # Special case for disabled servos
+        duty_cycle = self._kit.get_duty(self.channel)
+        if duty_cycle == 0 and self._min_duty != 0:  # Special case for disabled servos
             return self._last_fraction
-        return ((self._pwm_out.duty_cycle - self._min_duty) / self._duty_range)
+        return ((duty_cycle - self._min_duty) / self._duty_range)
 
     @fraction.setter
     def fraction(self, value):
         if value is None:
-            self._pwm_out.duty_cycle = 0  # disable the motor
+            self._kit.set_duty(self.channel, 0)  # disable the motor
             self._last_fraction = None
             return
         if not 0.0 <= value <= 1.0:
             raise ValueError("Must be 0.0 to 1.0")
         duty_cycle = self._min_duty + int(value * self._duty_range)
-        self._pwm_out.duty_cycle = duty_cycle
+        self._kit.set_duty(self.channel, duty_cycle)
 
     @property
     def angle(self):
@@ -114,4 +170,4 @@ class Servo:
 
     def relax(self):
         self._last_fraction = self.fraction
-        self._pwm_out.duty_cycle = 0
+        self._kit.set_duty(self.channel, 0)
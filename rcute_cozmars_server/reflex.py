@@ -0,0 +1,131 @@
+import threading
+
+IR_SIDES = ('either', 'both', 'left', 'right')
+
+class Reflexes:
+    '''
+    Rules run right in the sensor callbacks, so the robot reacts without waiting for a round trip to the client.
+
+    * edge: `{'ir': 'either'|'both'|'left'|'right', 'value': 0}`, when the IR sensor(s) read `value`
+      (0 when nothing reflects the light under them, like past the edge of the table),
+      the robot is stopped if it's moving forward, and can't move forward until they don't
+    * obstacle: `{'distance': .1, 'speed': .3}`, when sonar reads less than `distance` in meters,
+      forward speed is capped to `speed`
+    * line following: drive along a line with the two IR sensors, see `follow`
+
+    Speeds are mapped speeds (as returned by `CozmarsServer.speed`), `read_speed()`/`write_speed(speed)` get/set them on the motors,
+    `emit(event, value)` reports what the reflexes do. Callbacks come from different threads, hence the lock
+    '''
+    def __init__(self, read_speed, write_speed, emit):
+        self.read_speed = read_speed
+        self.write_speed = write_speed
+        self.emit = emit
+        self.rules = {'edge': None, 'obstacle': None}
+        self._lock = threading.Lock()
+        self._ir = None # no reading yet, rules on the IR sensors wait for one
+        self._distance = None
+        self._edge = self._obstacle = False
+        self._follow = None
+
+    def set_rule(self, name, rule):
+        if name not in self.rules:
+            raise ValueError(f'Unknown reflex {name}, must be one of {list(self.rules)}')
+        if rule is not None:
+            if name == 'edge':
+                rule = {'ir': 'either', 'value': 0, **rule}
+                if rule['ir'] not in IR_SIDES:
+                    raise ValueError(f'ir must be one of {IR_SIDES}')
+            else:
+                rule = {'speed': 0, **rule}
+                if not rule.get('distance', 0) > 0:
+                    raise ValueError('distance must be positive')
+                if not 0 <= rule['speed'] <= 1:
+                    raise ValueError('speed must be 0 ~ 1')
+        with self._lock:
+            self.rules[name] = rule
+            self._edge = self._obstacle = False
+            self._evaluate()
+
+    def reset(self):
+        '''forget the sensor readings, e.g. when the sensors are closed'''
+        with self._lock:
+            self._ir = self._distance = None
+            self._edge = self._obstacle = False
+
+    def follow(self, speed=None, turn=.5, line=0):
+        '''
+        follow a line at `speed`, steering by slowing down the wheel on the side that sees the line (IR reads `line`, 0 for a dark line) by `turn`.
+        The robot stops when both sensors lose the line, and goes on once it's found again. `speed` None stops following
+        '''
+        if speed is not None and not (0 < speed <= 1 and 0 <= turn <= 2):
+            raise ValueError('speed must be 0 ~ 1, turn 0 ~ 2')
+        with self._lock:
+            was_following = self._follow
+            self._follow = speed and (speed, turn, line)
+            if self._follow:
+                self._steer()
+            elif was_following:
+                self.write_speed((0, 0))
+
+    @property
+    def following(self):
+        return bool(self._follow)
+
+    @property
+    def edge(self):
+        return self._edge
+
+    @property
+    def obstacle(self):
+        return self._obstacle
+
+    def limit(self, speed):
+        '''cap `speed` while a rule is triggered, returns `speed` itself if it's not changed'''
+        cap = 0 if self._edge else self.rules['obstacle']['speed'] if self._obstacle else None
+        if cap is None or sum(speed) <= 0 or max(speed) <= cap:
+            return speed
+        return tuple(min(s, cap) for s in speed)
+
+    def on_ir(self, left, right):
+        with self._lock:
+            self._ir = (left, right)
+            self._evaluate()
+            self._follow and self._steer()
+
+    def on_distance(self, distance):
+        with self._lock:
+            self._distance = distance
+            self._evaluate()
+
+    def _steer(self):
+        if self._ir is None:
+            return
+        speed, turn, line = self._follow
+        left, right = (v == line for v in self._ir)
+        if left and right or not (left or right):
+            target = (speed, speed) if left else (0, 0)
+        else:
+            # the line is under the left sensor when the robot drifts right of it, turn left
+            target = (speed - turn, speed) if left else (speed, speed - turn)
+        self.write_speed(self.limit(tuple(max(-1, s) for s in target)))
+        if not (left or right):
+            self.emit('line_lost', True)
+
+    def _evaluate(self):
+        edge, obstacle = self.rules['edge'], self.rules['obstacle']
+        if edge and self._ir is not None:
+            hits = [v == edge['value'] for v in self._ir]
+            triggered = {'either': any(hits), 'both': all(hits), 'left': hits[0], 'right': hits[1]}[edge['ir']]
+        else:
+            triggered = False
+        if triggered != self._edge:
+            self._edge = triggered
+            self.emit('edge', list(self._ir) if triggered else None)
+        triggered = bool(obstacle and self._distance is not None and self._distance < obstacle['distance'])
+        if triggered != self._obstacle:
+            self._obstacle = triggered
+            self.emit('obstacle', self._distance if triggered else None)
+        if self._edge or self._obstacle:
+            speed = self.read_speed()
+            limited = self.limit(speed)
+            limited is speed or self.write_speed(limited)
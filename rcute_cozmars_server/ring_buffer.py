@@ -0,0 +1,73 @@
+import threading
+
+class ByteRing:
+    '''
+    A preallocated byte ring between the event loop (`write`) and an audio callback (`read_into`).
+
+    Chunks of any size can be written. When the ring is full, the oldest bytes are dropped to keep the latency bounded,
+    and that's counted as an overrun. Reading starts only once `prebuffer` bytes are buffered, and starts over
+    after the ring runs dry (an underrun), so a network hiccup makes one short gap rather than crackling.
+    `read_into` doesn't allocate, it's meant for real time callbacks
+    '''
+    def __init__(self, capacity, prebuffer=0, align=1):
+        capacity -= capacity % align
+        self.buf = bytearray(capacity)
+        self._view = memoryview(self.buf)
+        self.capacity = capacity
+        self.prebuffer = min(prebuffer, capacity)
+        self.align = align # bytes per frame, dropping keeps frames whole
+        self._read = self._size = 0
+        self._lock = threading.Lock()
+        self.primed = False
+        self.ended = False
+        self.underruns = self.overruns = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        if len(data) > self.capacity:
+            data = data[len(data) - self.capacity:]
+            self.overruns += 1
+        with self._lock:
+            over = self._size + len(data) - self.capacity
+            if over > 0:
+                over += -over % self.align
+                self._read = (self._read + over) % self.capacity
+                self._size -= over
+                self.overruns += 1
+            start = (self._read + self._size) % self.capacity
+            n = min(len(data), self.capacity - start)
+            self._view[start:start+n] = data[:n]
+            self._view[:len(data)-n] = data[n:]
+            self._size += len(data)
+            if self._size >= self.prebuffer:
+                self.primed = True
+
+    def end(self):
+        '''no more data, what's buffered can be read even if it's less than `prebuffer`'''
+        self.ended = True
+        self.primed = True
+
+    def read_into(self, out):
+        '''
+        fill `out` with buffered bytes and the rest with zeros, returns the number of bytes filled from the ring,
+        which is less than `len(out)` on an underrun
+        '''
+        with self._lock:
+            n = min(len(out), self._size) if self.primed else 0
+            first = min(n, self.capacity - self._read)
+            out[:first] = self._view[self._read:self._read+first]
+            out[first:n] = self._view[:n-first]
+            self._read = (self._read + n) % self.capacity
+            self._size -= n
+            if n < len(out):
+                out[n:] = bytes(len(out) - n) if len(out) - n > len(self._zeros) else self._zeros[:len(out)-n]
+                if self.primed and not self.ended:
+                    self.underruns += 1
+                    self.primed = self.prebuffer == 0
+        return n
+
+    _zeros = memoryview(bytes(8192))
@@ -0,0 +1,40 @@
+import threading
+import numpy as np
+
+RECORD = np.dtype([('t', '<f8'), ('v', '<f4')]) # time.monotonic() and the value, as packed in `query` results
+
+class History:
+    '''the last `size` readings of a sensor in a preallocated ring, safe to append from another thread'''
+    def __init__(self, size):
+        self.buf = np.zeros(size, dtype=RECORD)
+        self.count = 0 # total appended, the next one goes to `count % size`
+        self._lock = threading.Lock()
+
+    def append(self, t, value):
+        with self._lock:
+            self.buf[self.count % len(self.buf)] = (t, value)
+            self.count += 1
+
+    def query(self, start=None, end=None):
+        '''readings with `start` <= t <= `end`, oldest first'''
+        with self._lock:
+            n, size = self.count, len(self.buf)
+            records = self.buf[:n] if n <= size else np.roll(self.buf, -(n % size))
+            lo = 0 if start is None else np.searchsorted(records['t'], start, 'left')
+            hi = len(records) if end is None else np.searchsorted(records['t'], end, 'right')
+            return records[lo:hi].copy()
+
+class SensorHistory:
+    def __init__(self, names, size=1024):
+        self.histories = {name: History(size) for name in names}
+
+    def record(self, name, t, value):
+        self.histories[name].append(t, 0 if value is None else value)
+
+    def query(self, names=None, start=None, end=None):
+        '''`{name: bytes}` of the packed `RECORD`s of each sensor in `names` (all if None)'''
+        names = names or list(self.histories)
+        for name in names:
+            if name not in self.histories:
+                raise ValueError(f'Unknown sensor {name}, must be one of {list(self.histories)}')
+        return {name: self.histories[name].query(start, end).tobytes() for name in names}
@@ -0,0 +1,28 @@
+import asyncio
+import numpy as np
+
+class Sound:
+    '''a mono PCM clip kept on the robot, so it can be played without streaming it again'''
+    def __init__(self, data, samplerate, dtype='int16'):
+        self.samples = np.frombuffer(bytes(data), dtype=dtype)
+        self.samplerate = samplerate
+        self.dtype = dtype
+
+    @property
+    def nbytes(self):
+        return self.samples.nbytes
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.samplerate
+
+    def stream(self, blocksize):
+        '''a queue of `blocksize`-frame blocks ending with `StopAsyncIteration`, to feed `CozmarsServer.speaker`'''
+        q = asyncio.Queue()
+        n = -(-len(self.samples) // blocksize) * blocksize
+        padded = np.zeros(n, dtype=self.samples.dtype)
+        padded[:len(self.samples)] = self.samples
+        for block in padded.reshape(-1, blocksize):
+            q.put_nowait(block.tobytes())
+        q.put_nowait(StopAsyncIteration())
+        return q
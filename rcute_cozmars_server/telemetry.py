@@ -0,0 +1,55 @@
+'''
+Sensor state coalesced into one fixed size frame per tick, see `stream`.
+
+A frame is `FRAME` packed, little-endian:
+
+* seq, uint32: incremented by every frame sent
+* t, float64: time.monotonic() on the robot when the state was sampled
+* bits, uint8: `BITS` from the lowest bit up
+* presses, uint8: button presses so far, wrapping around, so no press is lost between two frames
+* distance, uint16: sonar distance in millimeters, 0xFFFF if there's no reading yet
+* missed, uint16: ticks skipped so far because the client didn't keep up, wrapping around
+'''
+import asyncio
+import struct
+
+FRAME = struct.Struct('<IdBBHH')
+BITS = ('lir', 'rir', 'pressed', 'held', 'edge', 'obstacle', 'following')
+NO_DISTANCE = 0xFFFF
+
+def quantize(distance, resolution):
+    '''sonar distance in meters to millimeters, rounded to `resolution` meters so noise doesn't make every frame a change'''
+    if distance is None:
+        return NO_DISTANCE
+    return min(NO_DISTANCE - 1, int(round(distance / resolution) * resolution * 1000))
+
+def pack_bits(state):
+    return sum(1 << i for i, name in enumerate(BITS) if state.get(name))
+
+async def stream(snapshot, rate=20, keepalive=1, resolution=.01):
+    '''
+    yield a frame at most every `1/rate` seconds, only when the state returned by `snapshot()` has changed,
+    or after `keepalive` seconds without a change. `snapshot()` returns `(state, presses, distance)`,
+    `state` being a dict of `BITS` names to bools.
+    Nothing is queued: when the client stalls, the ticks it misses are counted and the next frame has the latest state
+    '''
+    loop = asyncio.get_running_loop()
+    interval = 1 / rate
+    seq = missed = 0
+    last = None
+    next_t = last_sent = loop.time()
+    while True:
+        next_t += interval
+        await asyncio.sleep(next_t - loop.time())
+        now = loop.time()
+        if now - next_t >= interval:
+            skipped = int((now - next_t) / interval)
+            missed += skipped
+            next_t += skipped * interval
+        state, presses, distance = snapshot()
+        current = (pack_bits(state), presses & 0xFF, quantize(distance, resolution))
+        if current == last and now - last_sent < keepalive:
+            continue
+        yield FRAME.pack(seq & 0xFFFFFFFF, now, *current, missed & 0xFFFF)
+        seq += 1
+        last, last_sent = current, now
@@ -0,0 +1,71 @@
+import asyncio
+import inspect
+
+class Timeline:
+    '''
+    A list of actions `[t, name, *args]` run at `t` seconds after the start of each pass,
+    a trailing dict in `args` holds keyword arguments, e.g. `[1.5, 'lift', 1, .5, {'easing': 'min_jerk'}]`.
+
+    `actions` maps action names to coroutine functions, every action is checked against the signature of its function
+    and with `check(name, args, kwargs)` before anything runs, so a bad timeline fails as a whole
+    '''
+    def __init__(self, entries, actions, check=None):
+        self.entries = []
+        for i, entry in enumerate(entries):
+            try:
+                t, name, *args = entry
+                kwargs = args.pop() if args and isinstance(args[-1], dict) else {}
+                if not t >= 0:
+                    raise ValueError('time must be >= 0')
+                if name not in actions:
+                    raise ValueError(f'unknown action {name}, must be one of {list(actions)}')
+                inspect.signature(actions[name]).bind(*args, **kwargs)
+                check and check(name, args, kwargs)
+            except (TypeError, ValueError, KeyError) as e:
+                raise ValueError(f'Timeline action {i} {entry}: {e}') from None
+            self.entries.append((t, i, name, args, kwargs))
+        self.entries.sort(key=lambda e: e[:2]) # stable for actions at the same time
+        self.actions = actions
+        self.names = {e[2] for e in self.entries}
+
+    @property
+    def end(self):
+        return self.entries[-1][0] if self.entries else 0
+
+    async def run(self, emit, loop=1, period=None):
+        '''
+        run the actions `loop` times (0 for forever), a pass starts `period` seconds after the previous one,
+        or when all actions of the previous one have finished if `period` is None.
+        `emit(event)` is called with the progress: `['pass', n]`, `['action', index, lateness]` and `['error', index, message]`
+        '''
+        aloop = asyncio.get_running_loop()
+        tasks = set()
+
+        def done(task, index):
+            tasks.discard(task)
+            if not task.cancelled() and task.exception():
+                emit(['error', index, str(task.exception())])
+
+        n = 0
+        start = aloop.time()
+        try:
+            while not loop or n < loop:
+                emit(['pass', n])
+                for t, index, name, args, kwargs in self.entries:
+                    await asyncio.sleep(start + t - aloop.time())
+                    task = asyncio.create_task(self.actions[name](*args, **kwargs))
+                    task.add_done_callback(lambda task, index=index: done(task, index))
+                    tasks.add(task)
+                    emit(['action', index, round(aloop.time() - start - t, 4)])
+                n += 1
+                if period is None:
+                    tasks and await asyncio.wait(list(tasks))
+                    start = aloop.time()
+                else:
+                    start += period
+                    await asyncio.sleep(start - aloop.time())
+            tasks and await asyncio.wait(list(tasks))
+        finally:
+            for task in list(tasks):
+                task.cancel()
+        return n
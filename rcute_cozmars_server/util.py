@@ -1,5 +1,8 @@
+import os
 from os import path
 from PIL import Image, ImageFont, ImageDraw
+import numpy as np
+from .image_codec import rgb565
 import gettext, locale, re
 import asyncio
 
@@ -67,6 +70,34 @@ def splash_screen():
 
     return Image.open(splash)
 
+_screen_cache = {}
+
+def screen_data(name):
+    '''
+    RGB565 pixels in screen orientation of 'splash', 'poweroff' or 'reboot' screen.
+    They are converted once and saved as `<name>.565` next to the png, so later boots just read them back
+    '''
+    if name not in _screen_cache:
+        png = globals()[f'{name}_screen']()
+        raw = static(f'{name}.565')
+        data = None
+        if path.isfile(raw) and path.getmtime(raw) >= path.getmtime(png.filename):
+            data = np.fromfile(raw, dtype='>u2')
+            # a truncated or stale file is converted again
+            data = data.reshape(240, 135) if data.size == 240 * 135 else None
+        if data is None:
+            # rotate the same way `screen.image` does
+            data = np.ascontiguousarray(np.rot90(rgb565(png)))
+            try:
+                # written aside and renamed so a power cut can't leave a partial file
+                data.tofile(raw + '.tmp')
+                os.replace(raw + '.tmp', raw)
+            except OSError as e:
+                print(e)
+        png.close()
+        _screen_cache[name] = data
+    return _screen_cache[name]
+
 def beep(server):
     with open(static('sine_800hz_16k_i8.raw'), 'rb') as f:
         d = f.read()